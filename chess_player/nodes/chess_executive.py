@@ -21,7 +21,7 @@
 
 from __future__ import print_function
 
-import sys
+import os, socket, sys
 import rospy
 
 from chess_msgs.msg import *
@@ -32,6 +32,7 @@ from tf.listener import *
 from chess_player.chess_utilities import *
 from chess_player.sound_utilities import *
 from chess_player.head_utilities import *
+from chess_player.remote_utilities import RemoteEnginePool, ENGINE_PORT
 
 ###############################################################################
 # Executive for managing chess game
@@ -46,11 +47,60 @@ class ChessExecutive:
 
         # get arm planner
         rospy.loginfo('exec: Waiting for actions to connect.')
-        self.planner = ChessArmPlanner(listener = self.listener)
+        # which grasps and places have worked on each square, kept between runs
+        self.grasp_stats = GraspStats(rospy.get_param('~grasp_stats', os.path.expanduser('~/.ros/chess_grasp_stats')) or None)
+        self.planner = ChessArmPlanner(listener = self.listener, grasp_stats = self.grasp_stats,
+                                       retry_budget = rospy.get_param('~retry_budget', 60.0))
         self.planner.start()
 
         self.board = BoardState()
 
+        # warm engines shared between games, 0 to start one per game
+        self.engine_pool = None
+        pool_size = rospy.get_param('~engine_pool', 0)
+        if pool_size > 0:
+            self.engine_pool = EnginePool(pool_size)
+
+        # search on another machine (running engine_server.py), host name or '' for here
+        engine_server = rospy.get_param('~engine_server', '')
+        if engine_server != '':
+            port = rospy.get_param('~engine_server_port', ENGINE_PORT)
+            try:
+                self.engine_pool = RemoteEnginePool(engine_server, port)
+                rospy.loginfo('exec: Using engine server at %s:%d' % (engine_server, port))
+            except socket.error as e:
+                rospy.logerr('exec: Unable to reach engine server at %s:%d (%s), playing locally' % (engine_server, port, e))
+
+        # longest the engine may think about a move, before we move without it
+        self.engine_timeout = rospy.get_param('~engine_timeout', 60.0)
+        # False to play with the built in search only
+        self.use_gnuchess = rospy.get_param('~use_gnuchess', True)
+
+        # endgame tablebases, if we have them
+        self.tablebase = None
+        tablebase_path = rospy.get_param('~tablebase_path', '')
+        if tablebase_path != '':
+            self.tablebase = TablebaseProber(tablebase_path)
+            if self.tablebase.available():
+                rospy.loginfo('exec: Using %d tablebases, up to %d pieces' % (self.tablebase.count, self.tablebase.max_pieces))
+            else:
+                rospy.logwarn('exec: No tablebases in %s (or python-chess is missing)' % tablebase_path)
+                self.tablebase = None
+
+        # prefer moves the arm can make quickly, if they are within cost_margin centipawns
+        self.cost_model = MoveCostModel()
+        self.cost_margin = rospy.get_param('~cost_margin', 25)
+
+        # engine answers for positions we have seen before, kept between runs
+        self.move_cache = None
+        cache_path = rospy.get_param('~move_cache', os.path.expanduser('~/.ros/chess_move_cache'))
+        if cache_path != 'none':
+            if cache_path == '':
+                cache_path = None   # in memory only
+            self.move_cache = MoveCache(cache_path, max_age = rospy.get_param('~move_cache_max_age', None))
+        # seconds of gnuchess thinking a cached answer must be worth, weaker ones are searched again
+        self.move_cache_strength = rospy.get_param('~move_cache_strength', 1.0)
+
         if self.sim:
             self.yourMove = self.yourMoveKeyboard
             self.board.side = self.board.WHITE
@@ -58,10 +108,14 @@ class ChessExecutive:
         else:
             self.yourMove = self.yourMovePerception
             self.perception_times = list()
+            # longest we wait for the opponent to finish moving, before looking anyways
+            self.max_move_wait = rospy.get_param('~max_move_wait', 20.0)
 
             # subscribe to input
             self.updater = BoardUpdater(self.board)
-            rospy.Subscriber('chess_board_state', ChessBoard, self.updater.callback)
+            self.updater.start()
+            rospy.Subscriber('chess_board_state', ChessBoard, self.updater.receive, queue_size=1)
+            rospy.on_shutdown(self.updater.cancel)
 
             # maybe set side?
             try:
@@ -77,6 +131,10 @@ class ChessExecutive:
         self.speech = SpeechEngine()
         self.head = HeadEngine()
 
+        # called every wiggle_period seconds while we wait for a board, None to disable
+        self.wiggle_period = 5.0
+        self.wiggle_policy = self.head.wiggle_head
+
         rospy.loginfo('exec: Done initializing...')
 
     ###########################################################################
@@ -88,18 +146,28 @@ class ChessExecutive:
             print('Your move:')
         else:
             print('Invalid move, try again:')
+        self.board.previous = self.board.snapshot()    # so a move the engine rejects can be taken back
         self.board.last_move = raw_input().rstrip()
         if self.board.last_move == 'exit':
             self.engine.exit()
             exit()
-        self.board.applyMove(self.board.last_move)
+        try:
+            self.board.applyMove(self.board.last_move)
+        except ValueError as e:
+            print(e)
+            self.board.revert()
+            self.yourMoveKeyboard(True)
 
     def yourMovePerception(self, suppress_output = False):
         if not suppress_output:
             self.speech.say("Your move.")
-            rospy.sleep(10.0)
             self.head.look_at_board()
-            rospy.sleep(10.0)
+            self.updater.detector.start()
+            if self.updater.detector.waitForMove(self.max_move_wait):
+                self.perception_times.append(self.updater.detector.done_time - self.updater.detector.start_time)
+                rospy.loginfo("exec: Move finished after %.1fs" % self.perception_times[-1])
+            else:
+                rospy.loginfo("exec: No finished move seen, looking anyways")
         # update board state
         self.updateBoardState()
 
@@ -110,7 +178,12 @@ class ChessExecutive:
         """ This function plays a complete game. """
 
         # default board representation
-        self.engine = GnuChessEngine()
+        self.time_manager = TimeManager(rospy.get_param('~turn_time', 30.0))
+        self.engine = GnuChessEngine(pool = self.engine_pool, cache = self.move_cache,
+                                     timeout = self.engine_timeout, use_gnuchess = self.use_gnuchess,
+                                     time_manager = self.time_manager, tablebase = self.tablebase,
+                                     cost_model = self.cost_model, cost_margin = self.cost_margin,
+                                     cache_strength = self.move_cache_strength)
         self.board.newGame()
         self.head.look_at_board()
         if not self.sim:
@@ -148,11 +221,19 @@ class ChessExecutive:
             if self.board.last_move != "go":
                 self.speech.say("I see you have moved your " + self.board.getMoveText(self.board.last_move))
             rospy.loginfo("exec: My move: %s", move)
+            # think about the reply while we move
+            self.engine.ponder()
             if move in castling_extras.keys():
                 self.speech.say("Why oh why am I castling?")
             else:
                 self.speech.say("Moving my " + self.board.getMoveText(move))
+            start = rospy.Time.now()
             self.board.applyMove(move, self.planner.execute(move,self.board))
+            self.time_manager.recordArm((rospy.Time.now() - start).to_sec())
+            self.cost_model.update(self.planner)
+            # plan picks for our likely reply while the opponent thinks
+            board = self.board.snapshot()
+            self.engine.whenPondered(lambda predicted, reply: self.planner.speculate(predicted, reply, board))
             if not self.planner.success: 
                 self.engine.startPawning()
                 self.speech.say("Oh crap! I have failed")
@@ -162,31 +243,43 @@ class ChessExecutive:
     
     def updateBoardState(self, acceptNone = False):
         """ Updates board state by triggering pipeline. """
-        self.updater.up_to_date = False
-        updated_t = rospy.Time.now()
-        while not rospy.is_shutdown():
-            if (rospy.Time.now()-updated_t).to_sec() > 5.0:
-                self.head.wiggle_head()
-                updated_t = rospy.Time.now()
-            if self.updater.up_to_date:
-                if self.board.last_move == "none":
-                    if acceptNone:
-                        break
-                    else:
-                        self.updater.up_to_date = False
-                else:
-                    if acceptNone:
-                        self.updater.up_to_date = False
-                    else:
-                        break
-                updated_t = rospy.Time.now()
-            rospy.sleep(0.1)
+        if self.engine.position != None:
+            self.updater.position = self.engine.position.copy()
+        self.updater.request(self.board)
+        while not rospy.is_shutdown() and not self.updater.cancelled:
+            if self.updater.waitForBoard(self.wiggle_period):
+                (version, board) = self.updater.snapshots.read()
+                if (board.last_move == "none") == acceptNone:
+                    rospy.loginfo("exec: Using board version %d" % version)
+                    mailbox = self.updater.mailbox
+                    rospy.loginfo("exec: Frames received %d, coalesced %d, processed %d" %
+                                  (mailbox.received, mailbox.coalesced, mailbox.processed))
+                    self.board.assign(board)
+                    break
+                self.updater.request(self.board)
+            elif self.wiggle_policy != None:
+                self.wiggle_policy()
         self.board.printBoard()
         # pass transform
         self.planner.transform = self.updater.transform
 
     def getMove(self):
-        return self.engine.nextMove(self.board.last_move, self.board)
+        future = self.engine.requestMove(self.board.last_move, self.board)
+        move = future.result()
+        if move != None:
+            hit = ""
+            if future.ponder_hit:
+                hit = " (ponder hit)"
+            elif future.cache_hit:
+                hit = " (from cache)"
+            elif future.forced:
+                hit = " (only move)"
+            elif future.tablebase_hit:
+                hit = " (tablebase)"
+            elif self.engine.think_time != None:
+                hit = " (budget %.1fs)" % self.engine.think_time
+            rospy.loginfo("exec: Engine answered in %.2fs%s" % (future.latency(), hit))
+        return move
 
 if __name__=="__main__":
     sim = False
@@ -199,6 +292,11 @@ if __name__=="__main__":
         executive.board.printBoard()
         # shutdown gnuchess, so it doesn't shut us down
         executive.engine.exit()
+        if executive.move_cache != None:
+            executive.move_cache.close()
+        print('Grasp statistics:', executive.grasp_stats.getStats())
+        print('Speculative planning:', executive.planner.speculation)
+        executive.grasp_stats.close()
     except KeyboardInterrupt:
         pass
 
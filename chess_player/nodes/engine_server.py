@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+"""
+  Serves gnuchess to chess executives on other machines
+  Copyright (c) 2011-2013 Michael E. Ferguson.  All right reserved.
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software Foundation,
+  Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+
+import rospy
+
+from chess_player.engine_utilities import EnginePool
+from chess_player.remote_utilities import EngineServer, ENGINE_PORT
+
+if __name__=='__main__':
+    rospy.init_node('engine_server')
+    engines = rospy.get_param('~engines', 0)    # 0 for one per cpu
+    pool = EnginePool(engines or None)
+    server = EngineServer(pool, port = rospy.get_param('~port', ENGINE_PORT)).start()
+    rospy.loginfo('engine_server: %d engines on port %d' % (len(pool.processes), server.port))
+    rospy.spin()
+    server.close()
+    pool.close()
+    rospy.loginfo('engine_server: %s %s' % (server.getStats(), pool.getStats()))
@@ -0,0 +1,624 @@
+#!/usr/bin/env python
+
+"""
+  Copyright (c) 2011-2013 Michael E. Ferguson. All right reserved.
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software Foundation,
+  Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+
+import re
+
+# Bitboard legal move generation. Squares are numbered like BoardState
+#   indices: a1 = 0, b1 = 1, ..., h8 = 63.
+
+WHITE = 0
+BLACK = 1
+
+# piece kinds, ChessPiece type is +/-(kind + 2)
+PAWN = 0
+KNIGHT = 1
+BISHOP = 2
+ROOK = 3
+QUEEN = 4
+KING = 5
+
+PIECE_LETTERS = "pnbrqk"
+
+# castling rights
+WHITE_OO = 1
+WHITE_OOO = 2
+BLACK_OO = 4
+BLACK_OOO = 8
+
+# move flags, moves are encoded as from | to << 6 | promotion << 12 | flags << 16
+EN_PASSANT = 1
+CASTLE = 2
+DOUBLE_PUSH = 4
+
+FULL = 0xFFFFFFFFFFFFFFFF
+FILE_A = 0x0101010101010101
+FILE_H = FILE_A << 7
+RANK_1 = 0xFF
+RANK_3 = RANK_1 << 16
+RANK_6 = RANK_1 << 40
+RANK_8 = RANK_1 << 56
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+MOVE_RE = re.compile('^([a-h][1-8])([a-h][1-8])([nbrqNBRQ]?)$')
+
+def _leaper(offsets):
+    """ Attack table for a piece that jumps by (file, rank) offsets. """
+    table = list()
+    for sq in range(64):
+        f, r = sq % 8, sq // 8
+        bb = 0
+        for (df, dr) in offsets:
+            if 0 <= f+df < 8 and 0 <= r+dr < 8:
+                bb |= 1 << ((r+dr)*8 + f+df)
+        table.append(bb)
+    return table
+
+def _ray(df, dr):
+    """ Ray table for a sliding direction, not including the square itself. """
+    table = list()
+    for sq in range(64):
+        f, r = sq % 8 + df, sq // 8 + dr
+        bb = 0
+        while 0 <= f < 8 and 0 <= r < 8:
+            bb |= 1 << (r*8 + f)
+            f += df
+            r += dr
+        table.append(bb)
+    return table
+
+KNIGHT_ATTACKS = _leaper([(1,2),(2,1),(2,-1),(1,-2),(-1,-2),(-2,-1),(-2,1),(-1,2)])
+KING_ATTACKS = _leaper([(1,0),(1,1),(0,1),(-1,1),(-1,0),(-1,-1),(0,-1),(1,-1)])
+# squares attacked by a pawn of each color standing on a square
+PAWN_ATTACKS = [_leaper([(-1,1),(1,1)]), _leaper([(-1,-1),(1,-1)])]
+
+RAY_N, RAY_E, RAY_NE, RAY_NW = _ray(0,1), _ray(1,0), _ray(1,1), _ray(-1,1)
+RAY_S, RAY_W, RAY_SW, RAY_SE = _ray(0,-1), _ray(-1,0), _ray(-1,-1), _ray(1,-1)
+
+def _positive(rays, sq, occ):
+    ray = rays[sq]
+    blockers = ray & occ
+    if blockers:
+        ray ^= rays[(blockers & -blockers).bit_length()-1]
+    return ray
+
+def _negative(rays, sq, occ):
+    ray = rays[sq]
+    blockers = ray & occ
+    if blockers:
+        ray ^= rays[blockers.bit_length()-1]
+    return ray
+
+def rookAttacks(sq, occ):
+    return _positive(RAY_N, sq, occ) | _positive(RAY_E, sq, occ) | \
+           _negative(RAY_S, sq, occ) | _negative(RAY_W, sq, occ)
+
+def bishopAttacks(sq, occ):
+    return _positive(RAY_NE, sq, occ) | _positive(RAY_NW, sq, occ) | \
+           _negative(RAY_SW, sq, occ) | _negative(RAY_SE, sq, occ)
+
+# castling rights that survive a move touching a square
+CASTLE_MASK = [0xF] * 64
+CASTLE_MASK[0] = 0xF & ~WHITE_OOO
+CASTLE_MASK[4] = 0xF & ~(WHITE_OO | WHITE_OOO)
+CASTLE_MASK[7] = 0xF & ~WHITE_OO
+CASTLE_MASK[56] = 0xF & ~BLACK_OOO
+CASTLE_MASK[60] = 0xF & ~(BLACK_OO | BLACK_OOO)
+CASTLE_MASK[63] = 0xF & ~BLACK_OO
+
+# rook from/to for a castling king destination
+CASTLE_ROOK = { 6 : (7, 5), 2 : (0, 3), 62 : (63, 61), 58 : (56, 59) }
+
+def _splitmix64(seed):
+    """ Deterministic 64-bit generator, so keys are the same on every machine and run. """
+    while True:
+        seed = (seed + 0x9E3779B97F4A7C15) & FULL
+        z = seed
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & FULL
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & FULL
+        yield z ^ (z >> 31)
+
+_keys = _splitmix64(2011)
+# Zobrist keys indexed by [ChessPiece type + 7][square], this includes unknown types
+ZOBRIST_PIECE = [[next(_keys) for sq in range(64)] for t in range(15)]
+ZOBRIST_BLACK = next(_keys)
+ZOBRIST_CASTLING = [next(_keys) for i in range(16)]
+ZOBRIST_EP = [next(_keys) for f in range(8)]
+# same keys, indexed by Position piece index (color*6 + kind)
+PIECE_KEYS = [ZOBRIST_PIECE[7 + kind + 2] for kind in range(6)] + \
+             [ZOBRIST_PIECE[7 - kind - 2] for kind in range(6)]
+
+def pieceKey(piece_type, sq):
+    """ Zobrist key of a ChessPiece type on a square. """
+    return ZOBRIST_PIECE[piece_type + 7][sq]
+
+def squareName(sq):
+    return chr(ord('a') + sq % 8) + str(sq // 8 + 1)
+
+def squareIdx(name):
+    return (int(name[1])-1)*8 + ord(name[0])-ord('a')
+
+def makeMove(fr, to, promotion=0, flags=0):
+    return fr | (to << 6) | (promotion << 12) | (flags << 16)
+
+def moveFrom(move):
+    return move & 63
+
+def moveTo(move):
+    return (move >> 6) & 63
+
+def movePromotion(move):
+    return (move >> 12) & 7
+
+def moveFlags(move):
+    return move >> 16
+
+def moveToString(move):
+    """ Convert to the long algebraic form used by GNU chess ('e2e4', 'e7e8q'). """
+    s = squareName(move & 63) + squareName((move >> 6) & 63)
+    promotion = (move >> 12) & 7
+    if promotion:
+        s += PIECE_LETTERS[promotion]
+    return s
+
+def isMoveString(text):
+    """ Does this look like a move (as opposed to 'go', 'none', ...)? """
+    return text != None and MOVE_RE.match(text) != None
+
+class Position(object):
+    """
+    A chess position stored as bitboards, with a mailbox on the side,
+    that can generate legal moves, and make and unmake them.
+    """
+
+    __slots__ = ('bb', 'occ', 'squares', 'turn', 'castling', 'ep',
+                 'halfmove', 'fullmove', 'stack', 'placement')
+
+    def __init__(self):
+        """ Create an empty position, white to move. """
+        self.bb = [0] * 12          # indexed by color*6 + kind
+        self.occ = [0, 0]           # per color
+        self.squares = [-1] * 64    # color*6 + kind, or -1 if empty
+        self.turn = WHITE
+        self.castling = 0
+        self.ep = -1
+        self.halfmove = 0
+        self.fullmove = 1
+        self.stack = list()
+        self.placement = 0          # zobrist hash of the pieces only
+
+    @classmethod
+    def initial(cls):
+        return cls.fromFen(START_FEN)
+
+    @classmethod
+    def fromFen(cls, fen):
+        """ Create a position from a FEN string. """
+        fields = fen.split()
+        pos = cls()
+        rank, f = 7, 0
+        for c in fields[0]:
+            if c == '/':
+                rank -= 1
+                f = 0
+            elif c.isdigit():
+                f += int(c)
+            else:
+                color = WHITE if c.isupper() else BLACK
+                pos.put(rank*8 + f, color, PIECE_LETTERS.index(c.lower()))
+                f += 1
+        if len(fields) > 1 and fields[1] == 'b':
+            pos.turn = BLACK
+        if len(fields) > 2:
+            for c, right in zip("KQkq", [WHITE_OO, WHITE_OOO, BLACK_OO, BLACK_OOO]):
+                if c in fields[2]:
+                    pos.castling |= right
+        if len(fields) > 3 and fields[3] != '-':
+            pos.ep = squareIdx(fields[3])
+        if len(fields) > 5:
+            pos.halfmove = int(fields[4])
+            pos.fullmove = int(fields[5])
+        return pos
+
+    @classmethod
+    def fromBoard(cls, board, to_move=None):
+        """
+        Create a position from a BoardState. Pieces of unknown type are
+        not allowed. The side to move defaults to the opposite of whoever
+        made board.last_move (white if there is no last move). Castling
+        rights are assumed from kings and rooks on their home squares and
+        the en passant square is taken from board.last_move.
+        """
+        pos = cls()
+        for sq in range(64):
+            t = board.getPieceType(sq % 8, sq // 8 + 1)
+            if t == 0:
+                continue
+            if abs(t) < 2:
+                raise ValueError("unknown piece type on %s" % squareName(sq))
+            pos.put(sq, WHITE if t > 0 else BLACK, abs(t) - 2)
+        last = board.last_move
+        if to_move == None:
+            to_move = 1
+            if isMoveString(last):
+                to_move = -1 if board.getPieceType(last[2], int(last[3])) > 0 else 1
+        pos.turn = WHITE if to_move > 0 else BLACK
+        for (right, king, rook, p) in [(WHITE_OO, 4, 7, 0), (WHITE_OOO, 4, 0, 0),
+                                       (BLACK_OO, 60, 63, 6), (BLACK_OOO, 60, 56, 6)]:
+            if pos.squares[king] == p + KING and pos.squares[rook] == p + ROOK:
+                pos.castling |= right
+        if isMoveString(last):
+            fr, to = squareIdx(last[0:2]), squareIdx(last[2:4])
+            if pos.squares[to] % 6 == PAWN and abs(to - fr) == 16:
+                pos.ep = (fr + to) // 2
+        if pos.bb[KING] & (pos.bb[KING] - 1) or pos.bb[6+KING] & (pos.bb[6+KING] - 1) \
+                or not pos.bb[KING] or not pos.bb[6+KING]:
+            raise ValueError("each side needs exactly one king")
+        return pos
+
+    def toFen(self):
+        rows = list()
+        for rank in range(7, -1, -1):
+            row, empty = "", 0
+            for f in range(8):
+                p = self.squares[rank*8 + f]
+                if p < 0:
+                    empty += 1
+                    continue
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                c = PIECE_LETTERS[p % 6]
+                row += c.upper() if p < 6 else c
+            if empty:
+                row += str(empty)
+            rows.append(row)
+        castling = "".join([c for c, right in zip("KQkq", [WHITE_OO, WHITE_OOO, BLACK_OO, BLACK_OOO])
+                            if self.castling & right]) or "-"
+        ep = squareName(self.ep) if self.ep >= 0 else "-"
+        return "%s %s %s %s %d %d" % ("/".join(rows), "wb"[self.turn], castling, ep,
+                                      self.halfmove, self.fullmove)
+
+    def fenKey(self):
+        """ Pieces, side to move, castling and en passant, without move counters. """
+        return " ".join(self.toFen().split()[0:4])
+
+    def copy(self):
+        pos = Position()
+        pos.bb = self.bb[:]
+        pos.occ = self.occ[:]
+        pos.squares = self.squares[:]
+        pos.turn = self.turn
+        pos.castling = self.castling
+        pos.ep = self.ep
+        pos.halfmove = self.halfmove
+        pos.fullmove = self.fullmove
+        pos.placement = self.placement
+        pos.stack = self.stack[:]   # moves can still be unmade, and repetitions found
+        return pos
+
+    def put(self, sq, color, kind):
+        """ Place a piece on an empty square. """
+        bit = 1 << sq
+        self.bb[color*6 + kind] |= bit
+        self.occ[color] |= bit
+        self.squares[sq] = color*6 + kind
+        self.placement ^= PIECE_KEYS[color*6 + kind][sq]
+
+    def key(self):
+        """
+        Zobrist hash of the position: pieces, side to move, castling
+        rights and en passant file. Pieces hash the same way as
+        BoardState.zobrist, so the two can be compared.
+        """
+        k = self.placement ^ ZOBRIST_CASTLING[self.castling]
+        if self.turn == BLACK:
+            k ^= ZOBRIST_BLACK
+        if self.ep >= 0:
+            k ^= ZOBRIST_EP[self.ep % 8]
+        return k
+
+    def isRepetition(self):
+        """ Was this position seen before, since the last capture or pawn move? """
+        stack = self.stack
+        for k in range(2, min(self.halfmove, len(stack)) + 1, 2):
+            (move, captured, castling, ep, halfmove, placement) = stack[-k]
+            if placement == self.placement and castling == self.castling and ep == self.ep:
+                return True
+        return False
+
+    #######################################################
+    # attacks
+    def attacked(self, sq, by):
+        """ Is a square attacked by the given color? """
+        bb = self.bb
+        o = by*6
+        if KNIGHT_ATTACKS[sq] & bb[o+KNIGHT] or KING_ATTACKS[sq] & bb[o+KING] or \
+           PAWN_ATTACKS[by^1][sq] & bb[o+PAWN]:
+            return True
+        occ = self.occ[0] | self.occ[1]
+        queens = bb[o+QUEEN]
+        if bishopAttacks(sq, occ) & (bb[o+BISHOP] | queens):
+            return True
+        return rookAttacks(sq, occ) & (bb[o+ROOK] | queens) != 0
+
+    def kingSquare(self, color):
+        return self.bb[color*6 + KING].bit_length() - 1
+
+    def inCheck(self):
+        return self.attacked(self.kingSquare(self.turn), self.turn^1)
+
+    #######################################################
+    # move generation
+    def pseudoMoves(self):
+        """ Generate moves without checking if our king is left in check. """
+        moves = list()
+        us = self.turn
+        them = us ^ 1
+        o = us*6
+        bb = self.bb
+        own = self.occ[us]
+        enemy = self.occ[them]
+        occ = own | enemy
+        empty = ~occ & FULL
+
+        # pawns
+        pawns = bb[o+PAWN]
+        if us == WHITE:
+            single = (pawns << 8) & empty
+            double = ((single & RANK_3) << 8) & empty
+            left = ((pawns & ~FILE_A) << 7) & FULL
+            right = ((pawns & ~FILE_H) << 9) & FULL
+            push, dleft, dright, promo_rank = 8, 7, 9, RANK_8
+        else:
+            single = (pawns >> 8) & empty
+            double = ((single & RANK_6) >> 8) & empty
+            left = (pawns & ~FILE_H) >> 7
+            right = (pawns & ~FILE_A) >> 9
+            push, dleft, dright, promo_rank = -8, -7, -9, RANK_1
+        targets = [(single, push, 0), (double, 2*push, DOUBLE_PUSH),
+                   (left & enemy, dleft, 0), (right & enemy, dright, 0)]
+        if self.ep >= 0:
+            epbb = 1 << self.ep
+            targets.append((left & epbb, dleft, EN_PASSANT))
+            targets.append((right & epbb, dright, EN_PASSANT))
+        for (b, delta, flags) in targets:
+            while b:
+                lsb = b & -b
+                to = lsb.bit_length() - 1
+                b ^= lsb
+                fr = to - delta
+                if lsb & promo_rank:
+                    for promotion in (QUEEN, ROOK, BISHOP, KNIGHT):
+                        moves.append(fr | (to << 6) | (promotion << 12))
+                else:
+                    moves.append(fr | (to << 6) | (flags << 16))
+
+        # pieces
+        not_own = ~own & FULL
+        for kind in (KNIGHT, BISHOP, ROOK, QUEEN, KING):
+            b = bb[o+kind]
+            while b:
+                lsb = b & -b
+                fr = lsb.bit_length() - 1
+                b ^= lsb
+                if kind == KNIGHT:
+                    att = KNIGHT_ATTACKS[fr]
+                elif kind == BISHOP:
+                    att = bishopAttacks(fr, occ)
+                elif kind == ROOK:
+                    att = rookAttacks(fr, occ)
+                elif kind == QUEEN:
+                    att = bishopAttacks(fr, occ) | rookAttacks(fr, occ)
+                else:
+                    att = KING_ATTACKS[fr]
+                att &= not_own
+                while att:
+                    t = att & -att
+                    att ^= t
+                    moves.append(fr | ((t.bit_length() - 1) << 6))
+
+        # castling, squares between must be empty and the king may not
+        #   start in, pass through or land in check
+        rights = self.castling & ((WHITE_OO | WHITE_OOO) if us == WHITE else (BLACK_OO | BLACK_OOO))
+        if rights:
+            k = 4 if us == WHITE else 60
+            if self.squares[k] == o+KING and not self.attacked(k, them):
+                if rights & (WHITE_OO | BLACK_OO) and self.squares[k+3] == o+ROOK and \
+                   not occ & (3 << (k+1)) and \
+                   not self.attacked(k+1, them) and not self.attacked(k+2, them):
+                    moves.append(k | ((k+2) << 6) | (CASTLE << 16))
+                if rights & (WHITE_OOO | BLACK_OOO) and self.squares[k-4] == o+ROOK and \
+                   not occ & (7 << (k-3)) and \
+                   not self.attacked(k-1, them) and not self.attacked(k-2, them):
+                    moves.append(k | ((k-2) << 6) | (CASTLE << 16))
+        return moves
+
+    def legalMoves(self):
+        """ Generate all legal moves. """
+        moves = list()
+        us = self.turn
+        for m in self.pseudoMoves():
+            self.push(m)
+            if not self.attacked(self.kingSquare(us), us^1):
+                moves.append(m)
+            self.pop()
+        return moves
+
+    def parseMove(self, text):
+        """
+        Find the legal move matching a string like 'e2e4' or 'e7e8q'.
+        A promotion without a piece letter is taken to be a queen.
+        Returns None if the move is not legal.
+        """
+        match = MOVE_RE.match(text.strip()) if text != None else None
+        if match == None:
+            return None
+        fr = squareIdx(match.group(1))
+        to = squareIdx(match.group(2))
+        promotion = 0
+        if match.group(3):
+            promotion = PIECE_LETTERS.index(match.group(3).lower())
+        elif self.squares[fr] % 6 == PAWN and self.squares[fr] >= 0 and (to < 8 or to >= 56):
+            promotion = QUEEN
+        for m in self.legalMoves():
+            if m & 63 == fr and (m >> 6) & 63 == to and (m >> 12) & 7 == promotion:
+                return m
+        return None
+
+    def isLegal(self, text):
+        return self.parseMove(text) != None
+
+    #######################################################
+    # make/unmake
+    def push(self, move):
+        """ Make a move, it is not checked for legality. """
+        fr = move & 63
+        to = (move >> 6) & 63
+        promotion = (move >> 12) & 7
+        flags = move >> 16
+        us = self.turn
+        bb = self.bb
+        occ = self.occ
+        squares = self.squares
+        p = squares[fr]
+        captured = squares[to]
+        self.stack.append((move, captured, self.castling, self.ep, self.halfmove, self.placement))
+
+        frbb = 1 << fr
+        tobb = 1 << to
+        h = self.placement
+        if captured >= 0:
+            bb[captured] ^= tobb
+            occ[us^1] ^= tobb
+            h ^= PIECE_KEYS[captured][to]
+        elif flags & EN_PASSANT:
+            capsq = to - 8 if us == WHITE else to + 8
+            capbb = 1 << capsq
+            bb[(us^1)*6 + PAWN] ^= capbb
+            occ[us^1] ^= capbb
+            squares[capsq] = -1
+            h ^= PIECE_KEYS[(us^1)*6 + PAWN][capsq]
+        bb[p] ^= frbb | tobb
+        occ[us] ^= frbb | tobb
+        squares[fr] = -1
+        squares[to] = p
+        keys = PIECE_KEYS[p]
+        h ^= keys[fr] ^ keys[to]
+        if promotion:
+            bb[p] ^= tobb
+            bb[us*6 + promotion] |= tobb
+            squares[to] = us*6 + promotion
+            h ^= keys[to] ^ PIECE_KEYS[us*6 + promotion][to]
+        if flags & CASTLE:
+            (rfr, rto) = CASTLE_ROOK[to]
+            rbb = (1 << rfr) | (1 << rto)
+            bb[us*6 + ROOK] ^= rbb
+            occ[us] ^= rbb
+            squares[rto] = squares[rfr]
+            squares[rfr] = -1
+            keys = PIECE_KEYS[us*6 + ROOK]
+            h ^= keys[rfr] ^ keys[rto]
+        self.placement = h
+
+        self.castling &= CASTLE_MASK[fr] & CASTLE_MASK[to]
+        self.ep = (fr + to) // 2 if flags & DOUBLE_PUSH else -1
+        if p % 6 == PAWN or captured >= 0:
+            self.halfmove = 0
+        else:
+            self.halfmove += 1
+        if us == BLACK:
+            self.fullmove += 1
+        self.turn = us ^ 1
+
+    def pop(self):
+        """ Unmake the last move. """
+        (move, captured, self.castling, self.ep, self.halfmove, self.placement) = self.stack.pop()
+        fr = move & 63
+        to = (move >> 6) & 63
+        promotion = (move >> 12) & 7
+        flags = move >> 16
+        self.turn ^= 1
+        us = self.turn
+        if us == BLACK:
+            self.fullmove -= 1
+        bb = self.bb
+        occ = self.occ
+        squares = self.squares
+        p = squares[to]
+        frbb = 1 << fr
+        tobb = 1 << to
+        if promotion:
+            bb[p] ^= tobb
+            p = us*6 + PAWN
+            bb[p] |= tobb
+        bb[p] ^= frbb | tobb
+        occ[us] ^= frbb | tobb
+        squares[fr] = p
+        squares[to] = captured
+        if captured >= 0:
+            bb[captured] |= tobb
+            occ[us^1] |= tobb
+        elif flags & EN_PASSANT:
+            capsq = to - 8 if us == WHITE else to + 8
+            capbb = 1 << capsq
+            bb[(us^1)*6 + PAWN] |= capbb
+            occ[us^1] |= capbb
+            squares[capsq] = (us^1)*6 + PAWN
+        if flags & CASTLE:
+            (rfr, rto) = CASTLE_ROOK[to]
+            rbb = (1 << rfr) | (1 << rto)
+            bb[us*6 + ROOK] ^= rbb
+            occ[us] ^= rbb
+            squares[rfr] = squares[rto]
+            squares[rto] = -1
+
+    def pushString(self, text):
+        """ Make a move given as a string, returns False if it is not legal. """
+        m = self.parseMove(text)
+        if m == None:
+            return False
+        self.push(m)
+        return True
+
+    #######################################################
+    # counting
+    def perft(self, depth):
+        """ Count leaf nodes of the legal move tree to a given depth. """
+        if depth == 0:
+            return 1
+        moves = self.legalMoves()
+        if depth == 1:
+            return len(moves)
+        nodes = 0
+        for m in moves:
+            self.push(m)
+            nodes += self.perft(depth-1)
+            self.pop()
+        return nodes
+
+    def divide(self, depth):
+        """ Perft split by root move, handy for finding generator bugs. """
+        result = dict()
+        for m in self.legalMoves():
+            self.push(m)
+            result[moveToString(m)] = self.perft(depth-1)
+            self.pop()
+        return result
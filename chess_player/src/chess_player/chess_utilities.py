@@ -20,18 +20,30 @@
 
 import copy, math
 import rospy    # for logging
-import pexpect  # for connecting to gnu chess
+import shelve
 import threading
+import time
+import numpy as np
 
 from chess_msgs.msg import *
 from geometry_msgs.msg import Pose, PoseStamped
 from moveit_msgs.msg import *
 
 from chess_player.robot_defs import *
+from chess_player.perception_utilities import BoardFusion, MoveDetector, Mailbox, MailboxWorker
+from chess_player.engine_utilities import MoveFuture, EngineWorker, EngineProcess, EnginePool, MoveCache, EngineError, TimeManager, \
+    MoveCostModel
+from chess_player.search_utilities import SearchEngine
+from chess_player.tablebase_utilities import TablebaseProber
+from chess_player.remote_utilities import RemoteEnginePool
+from chess_player.bitboard_utilities import Position, isMoveString, pieceKey, moveToString, \
+    moveFrom, moveTo, moveFlags, movePromotion, ZOBRIST_PIECE, QUEEN, EN_PASSANT, CASTLE, CASTLE_ROOK
 from moveit_python import *
 
 from geometry_msgs.msg import PoseStamped
 from moveit_msgs.msg import Grasp, GripperTranslation, PlaceLocation
+from moveit_msgs.srv import ApplyPlanningScene
+from shape_msgs.msg import SolidPrimitive
 from trajectory_msgs.msg import JointTrajectory, JointTrajectoryPoint
 
 from tf.broadcaster import *
@@ -39,37 +51,129 @@ from tf.listener import *
 from tf.transformations import euler_from_quaternion, quaternion_from_euler
 
 from threading import Thread
+from array import array
+from collections import OrderedDict
 
 SQUARE_SIZE = 0.05715
 
+# zobrist keys, as an array for hashing whole boards at once
+ZOBRIST_TABLE = np.array(ZOBRIST_PIECE, dtype=np.uint64)
+
 # extra move to be made for castling
 castling_extras = { "e1c1" : "a1d1",
                     "e1g1" : "h1f1",
                     "e8c8" : "a8d8",
                     "e8g8" : "h8f8" }
 
-class BoardState:
-    """ A representation of a chess board state. """
+# strength of cached moves: gnuchess answers count their seconds of thinking,
+# the built in search this much per ply, so its answers stay below gnuchess'
+SEARCH_STRENGTH = 0.01
+
+# gripper yaws and pitches tried for grasps and places, wider pitches once those keep failing
+GRASP_YAWS = [-1.57, -0.78, 0, 0.78, 1.57]
+GRASP_PITCHES = [0, 0.2, -0.2, 0.4, -0.4]
+MEGA_PITCHES = GRASP_PITCHES + [0.3, -0.3, 0.5, -0.5, 0.6, -0.6]
+
+# candidate names (yaw/pitch) and how good we think they are before trying them
+CANDIDATE_NAMES = dict((mega, ['%.2f/%.2f' % (y, p) for y in GRASP_YAWS for p in pitches])
+                       for (mega, pitches) in [(False, GRASP_PITCHES), (True, MEGA_PITCHES)])
+CANDIDATE_PRIOR = dict(('%.2f/%.2f' % (y, p), 1.0 - abs(p/2.0)) for y in GRASP_YAWS for p in MEGA_PITCHES)
+
+def orientationTable(pitches, yaws):
+    """
+    Quaternions (x, y, z, w) without roll for every yaw and pitch, yaw
+    major, as quaternion_from_euler(0, pitch, yaw) would give them.
+    """
+    p, y = np.meshgrid(np.asarray(pitches) / 2.0, np.asarray(yaws) / 2.0)
+    p, y = p.ravel(), y.ravel()
+    return np.column_stack((-np.sin(p) * np.sin(y), np.sin(p) * np.cos(y),
+                            np.cos(p) * np.sin(y), np.cos(p) * np.cos(y)))
+
+def transformMatrix(transform):
+    """ 4x4 homogeneous matrix of a geometry_msgs Transform. """
+    t, q = transform.translation, transform.rotation
+    x, y, z, w = q.x, q.y, q.z, q.w
+    m = np.identity(4)
+    m[0:3, 0:3] = [[1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w)],
+                   [2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w)],
+                   [2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)]]
+    m[0:3, 3] = [t.x, t.y, t.z]
+    return m
+
+def transformPoses(transform, poses, matrix=None):
+    """
+    Map an N x 7 array of poses (x, y, z, qx, qy, qz, qw) through a
+    geometry_msgs Transform all at once, returns a new N x 7 array.
+    """
+    if matrix is None:
+        matrix = transformMatrix(transform)
+    poses = np.asarray(poses, dtype=np.float64).reshape(-1, 7)
+    out = np.empty_like(poses)
+    out[:, 0:3] = poses[:, 0:3].dot(matrix[0:3, 0:3].T) + matrix[0:3, 3]
+    # rotation of the transform, then that of the pose
+    r = transform.rotation
+    x, y, z, w = poses[:, 3], poses[:, 4], poses[:, 5], poses[:, 6]
+    out[:, 3] = r.w*x + r.x*w + r.y*z - r.z*y
+    out[:, 4] = r.w*y - r.x*z + r.y*w + r.z*x
+    out[:, 5] = r.w*z + r.x*y - r.y*x + r.z*w
+    out[:, 6] = r.w*w - r.x*x - r.y*y - r.z*z
+    return out
+
+class BoardState(object):
+    """
+    A representation of a chess board state.
+
+    Pieces are stored in flat typed arrays indexed by (rank-1)*8+column:
+    an int8 piece type, an index into the shared table of piece names
+    and a float32 pose (x, y, z, qx, qy, qz, qw). ChessPiece messages are
+    only created when asked for through getPiece(). Boards returned by
+    snapshot() share their arrays until one of them is modified.
+
+    The zobrist attribute is a 64-bit hash of piece types and squares,
+    kept up to date on every change, so it can be used to recognize a
+    position without looking at all 64 squares.
+    """
     WHITE = 1
     BLACK = -1
 
+    # id index of an empty square
+    EMPTY = -1
+    # number of floats stored per pose
+    POSE_SIZE = 7
+
+    # interned table of piece names (header.frame_id), shared by all boards
+    names = list()
+    name_index = dict()
+
+    __slots__ = ('types', 'ids', 'poses', '_shared', 'zobrist', 'last_move', 'side',
+                 'max_changes', 'output', 'castling_move', 'previous')
+
     def __init__(self, side=None):
         """
         Initialize an empty board
         """
-        self.values = [None for i in range(64)]
+        self.clear()
         self.last_move = "go"
         self.side = side
         self.max_changes = 2
         self.output = False
         self.castling_move = None
+        self.previous = None
+
+    def clear(self):
+        """ Remove all pieces. """
+        self.types = array('b', [0]) * 64
+        self.ids = array('h', [self.EMPTY]) * 64
+        self.poses = array('f', [0.0]) * (64*self.POSE_SIZE)
+        self._shared = False
+        self.zobrist = 0
 
     def newGame(self):
         """
         Initialize a new board
         """
         self.last_move = "go"
-        self.values = [None for i in range(64)]
+        self.clear()
         for i in range(8):
             self.setPiece(i, 2, self.makePiece(ChessPiece.WHITE_PAWN, i, 2, "wpawn"+str(i)))
             self.setPiece(i, 7, self.makePiece(ChessPiece.BLACK_PAWN, i, 7, "bpawn"+str(i)))
@@ -105,8 +209,7 @@ class BoardState:
         return p
 
     def copyPiece(self, val, copy):
-        p = self.makePiece(val, 0, 1)
-        p.header.frame_id = copy.header.frame_id # copy over name
+        p = self.makePiece(val, 0, 1, copy.header.frame_id) # copy over name
         p.pose = copy.pose
         return p
 
@@ -119,70 +222,127 @@ class BoardState:
         Column: 0 or 'a' = column A
         Rank:   1 = rank 1
         """
-        try:
-            self.values[int(int(rank)-1)*8+self.getColIdx(column)] = piece
-        except:
+        idx = self.getIdx(column, rank)
+        if idx == None:
             print column, rank
             rospy.loginfo("setPiece: invalid row/column")
+            return
+        if piece == None:
+            self.clearIdx(idx)
+        else:
+            self.setIdx(idx, piece.type, piece.header.frame_id, piece.pose)
 
     def getPiece(self, column, rank):
-        try:
-            return self.values[int(rank-1)*8+self.getColIdx(column)]
-        except:
+        idx = self.getIdx(column, rank)
+        if idx == None or self.ids[idx] == self.EMPTY:
             return None
+        return self.makeMsg(idx)
+
     def getPieceType(self, column, rank):
-        try:
-            return self.values[int(rank-1)*8+self.getColIdx(column)].type
-        except:
+        idx = self.getIdx(column, rank)
+        if idx == None:
             return 0
+        return self.types[idx]
 
     def printBoard(self):
         """ Print board state to screen. """
         if self.side == self.WHITE or self.side == None:
             for r in [8,7,6,5,4,3,2,1]:
                 for c in 'abcdefgh':
-                    p = self.getPiece(c,r)    # print a8 first
-                    if p == None:
+                    idx = self.getIdx(c,r)    # print a8 first
+                    if self.ids[idx] == self.EMPTY:
                         print " ",
                     else:
-                        print self.getPieceName(p.type),
+                        print self.getPieceName(self.types[idx]),
                 print ""
         else:
             for r in [1,2,3,4,5,6,7,8]:
                 for c in 'hgfedcba':
-                    p = self.getPiece(c,r)    # print h1 first
-                    if p == None:
+                    idx = self.getIdx(c,r)    # print h1 first
+                    if self.ids[idx] == self.EMPTY:
                         print " ",
                     else:
-                        print self.getPieceName(p.type),
+                        print self.getPieceName(self.types[idx]),
                 print ""
 
-        for r in [8,7,6,5,4,3,2,1]:
-            for c in 'abcdefgh':
-                p = self.getPiece(c,r)
-                #if p != None and p.header.frame_id == "chess_board":
-                #    print "Warning, frame is chess_board:", c+str(r)
+    def snapshot(self):
+        """
+        Get a copy of this board. The copy shares storage with this
+        board until either one of them is modified.
+        """
+        b = BoardState.__new__(BoardState)
+        b.restore(self)
+        b.last_move = self.last_move
+        b.side = self.side
+        b.max_changes = self.max_changes
+        b.output = self.output
+        b.castling_move = self.castling_move
+        b.previous = None
+        return b
+
+    def restore(self, board):
+        """ Take on the pieces of another board (copy-on-write). """
+        self.types = board.types
+        self.ids = board.ids
+        self.poses = board.poses
+        self.zobrist = board.zobrist
+        self._shared = board._shared = True
+
+    def assign(self, board):
+        """ Take on all of the state of another board (copy-on-write). """
+        self.restore(board)
+        self.side = board.side
+        self.last_move = board.last_move
+        self.castling_move = board.castling_move
+        self.previous = board.previous
 
     def revert(self):
-        self.values = self.previous[0]
-        self.last_move = self.previous[1]
+        if self.previous == None:
+            return
+        self.restore(self.previous)
+        self.last_move = self.previous.last_move
 
     def copyType(self, col_f, row_f, col_t, row_t, board):
-        fr = self.getPiece(col_f, row_f)
-        to = board.getPiece(col_t, row_t)
-        to.type = fr.type
-        to.header.frame_id = fr.header.frame_id  # TODO does this belong here?
-        board.setPiece(col_t,row_t,to)
+        fr = self.getIdx(col_f, row_f)
+        to = board.getIdx(col_t, row_t)
+        if board.ids[to] == board.EMPTY:
+            return
+        board._own()
+        board.zobrist ^= pieceKey(board.types[to], to) ^ pieceKey(self.types[fr], to)
+        board.types[to] = self.types[fr]
+        board.ids[to] = self.ids[fr]  # TODO does this belong here?
+
+    def setType(self, column, rank, piece_type, name):
+        """ Change the type and name of a piece, keeping its pose. """
+        idx = self.getIdx(column, rank)
+        if idx == None or self.ids[idx] == self.EMPTY:
+            return
+        self._own()
+        self.zobrist ^= pieceKey(self.types[idx], idx) ^ pieceKey(piece_type, idx)
+        self.types[idx] = piece_type
+        self.ids[idx] = self.internName(name)
 
     def applyMove(self, move, pose=None):
         """ Update the board state, given a move from GNU chess. """
         (col_f, rank_f) = self.toPosition(move[0:2])
         (col_t, rank_t) = self.toPosition(move[2:])
-        piece = self.getPiece(col_f, rank_f)
-        piece.pose = pose
-        self.setPiece(col_t, rank_t, piece)
-        self.setPiece(col_f, rank_f, None)
-        if move in castling_extras.keys():
+        fr = self.getIdx(col_f, rank_f)
+        to = self.getIdx(col_t, rank_t)
+        if self.ids[fr] == self.EMPTY:
+            raise ValueError("no piece on %s to move" % move[0:2])
+        piece_type = self.types[fr]
+        if pose == None:
+            # no measured pose, assume it is centered on the square
+            pose = self.getSquarePose(to)
+        if abs(piece_type) == ChessPiece.WHITE_PAWN and col_f != col_t and self.ids[to] == self.EMPTY:
+            # en passant, remove the pawn that was passed
+            self.clearIdx(self.getIdx(col_t, rank_f))
+        if len(move) > 4:
+            # promotion
+            piece_type = self.getPieceTypeFromName(move[4]) * (1 if piece_type > 0 else -1)
+        self.setIdx(to, piece_type, self.names[self.ids[fr]], pose)
+        self.clearIdx(fr)
+        if move in castling_extras.keys() and abs(piece_type) == ChessPiece.WHITE_KING:
             self.applyMove(castling_extras[move])
 
     def computeSide(self):
@@ -225,9 +385,97 @@ class BoardState:
         temp_board.setPiece('g', 8, self.copyPiece(ChessPiece.BLACK_KNIGHT, self.getPiece('b',1)) )
         temp_board.setPiece('h', 8, self.copyPiece(ChessPiece.BLACK_ROOK, self.getPiece('a',1)) )
 
-        self.values = temp_board.values
+        self.restore(temp_board)
         self.printBoard()
 
+    #######################################################
+    # array storage
+    def _own(self):
+        """ Copy shared arrays before modifying them. """
+        if self._shared:
+            self.types = self.types[:]
+            self.ids = self.ids[:]
+            self.poses = self.poses[:]
+            self._shared = False
+
+    def internName(self, name):
+        """ Get the index of a piece name in the shared name table. """
+        try:
+            return self.name_index[name]
+        except KeyError:
+            self.names.append(name)
+            self.name_index[name] = len(self.names)-1
+            return len(self.names)-1
+
+    def setIdx(self, idx, piece_type, name, pose):
+        """ Place a piece of given type, name and pose at an index. """
+        self._own()
+        if self.ids[idx] != self.EMPTY:
+            self.zobrist ^= pieceKey(self.types[idx], idx)
+        self.zobrist ^= pieceKey(piece_type, idx)
+        self.types[idx] = piece_type
+        self.ids[idx] = self.internName(name)
+        i = idx*self.POSE_SIZE
+        self.poses[i:i+self.POSE_SIZE] = array('f', [pose.position.x, pose.position.y, pose.position.z,
+                                                     pose.orientation.x, pose.orientation.y,
+                                                     pose.orientation.z, pose.orientation.w])
+
+    def clearIdx(self, idx):
+        """ Remove the piece at an index. """
+        if self.ids[idx] == self.EMPTY:
+            return
+        self._own()
+        self.zobrist ^= pieceKey(self.types[idx], idx)
+        self.types[idx] = 0
+        self.ids[idx] = self.EMPTY
+
+    def makeMsg(self, idx):
+        """ Create a ChessPiece message for the piece at an index. """
+        p = ChessPiece()
+        p.header.frame_id = self.names[self.ids[idx]]
+        p.type = self.types[idx]
+        (p.pose.position.x, p.pose.position.y, p.pose.position.z,
+         p.pose.orientation.x, p.pose.orientation.y,
+         p.pose.orientation.z, p.pose.orientation.w) = self.poses[idx*self.POSE_SIZE:(idx+1)*self.POSE_SIZE]
+        return p
+
+    def getSquarePose(self, idx):
+        """ Pose at the center of the square at an index, in the board frame. """
+        p = Pose()
+        if self.side == self.BLACK:
+            p.position.x = SQUARE_SIZE * (0.5 + 7 - idx%8)
+            p.position.y = SQUARE_SIZE * (0.5 + 7 - idx//8)
+        else:
+            p.position.x = SQUARE_SIZE * (0.5 + idx%8)
+            p.position.y = SQUARE_SIZE * (0.5 + idx//8)
+        p.position.z = 0.03
+        p.orientation.w = 1.0
+        return p
+
+    def load(self, occupied, types, ids, poses):
+        """
+        Replace all pieces from per-square numpy arrays: occupancy, type,
+        name index and pose (64x7).
+        """
+        self.clear()
+        np.frombuffer(self.types, dtype=np.int8)[:] = np.where(occupied, types, 0)
+        np.frombuffer(self.ids, dtype=np.int16)[:] = np.where(occupied, ids, self.EMPTY)
+        np.frombuffer(self.poses, dtype=np.float32).reshape(64, self.POSE_SIZE)[:] = poses
+        squares = np.flatnonzero(occupied)
+        self.zobrist = int(np.bitwise_xor.reduce(ZOBRIST_TABLE[np.asarray(types)[squares] + 7, squares]))
+
+    def getValues(self):
+        return [self.makeMsg(i) if self.ids[i] != self.EMPTY else None for i in range(64)]
+
+    def setValues(self, values):
+        self.clear()
+        for i in range(64):
+            if values[i] != None:
+                self.setIdx(i, values[i].type, values[i].header.frame_id, values[i].pose)
+
+    # list of ChessPiece messages (or None), one per square
+    values = property(getValues, setValues)
+
     #######################################################
     # helpers
     def toPosition(self, pos):
@@ -241,6 +489,17 @@ class BoardState:
         except:
             return col
 
+    def getIdx(self, column, rank):
+        """ Convert to index into piece arrays, None if not on the board. """
+        try:
+            col = self.getColIdx(column)
+            rank = int(rank)
+        except:
+            return None
+        if col < 0 or col > 7 or rank < 1 or rank > 8:
+            return None
+        return (rank-1)*8 + col
+
     def getColIdx(self, col):
         """ Convert to column integer index. """
         try:
@@ -282,6 +541,15 @@ class BoardState:
         else:
             return "x"
 
+    def getPieceTypeFromName(self, name):
+        """ Get the (white) piece type for a letter such as 'q' or 'N'. """
+        return { "p" : ChessPiece.WHITE_PAWN,
+                 "n" : ChessPiece.WHITE_KNIGHT,
+                 "b" : ChessPiece.WHITE_BISHOP,
+                 "r" : ChessPiece.WHITE_ROOK,
+                 "q" : ChessPiece.WHITE_QUEEN,
+                 "k" : ChessPiece.WHITE_KING }[name.lower()]
+
     def getPieceHeight(self, piece_type):
         name = self.getPieceName(piece_type)
         if name == "p" or name == "P":
@@ -324,261 +592,756 @@ class BoardState:
         text += "from " + move[0:2] + " to " + move[2:]
         return text
 
-    def isCastling(self, piece_new, piece_color, piece_gone):
-        """
-        Are we castling? Returns one of:
-            e1c1 - (also, rook a1d1)
-            e1g1 - (also, rook h1f1)
-            e8c8 - (also, rook a8d8)
-            e8g8 - (also, rook h8f8)
-        """
-        if len(piece_color) > 0 or len(piece_new) != 2 or len(piece_gone) != 2:
-            return None
-        if piece_new[0][1] == 1 and piece_new[1][1] == 1 and piece_gone[0][1] == 1 and piece_gone[1][1] == 1:
-            # possibly white castling?
-            if piece_new[0][0] == "c" and piece_new[1][0] == "d" and piece_gone[0][0] == "a" and piece_gone[1][0] == "e":
-                return "e1c1"
-            elif piece_new[1][0] == "c" and piece_new[0][0] == "d" and piece_gone[1][0] == "a" and piece_gone[0][0] == "e":
-                return "e1c1"
-            elif piece_new[0][0] == "g" and piece_new[1][0] == "f" and piece_gone[0][0] == "h" and piece_gone[1][0] == "e":
-                return "e1g1"
-            elif piece_new[1][0] == "g" and piece_new[0][0] == "f" and piece_gone[1][0] == "h" and piece_gone[0][0] == "e":
-                return "e1g1"
-            else:
-                return None
-        elif piece_new[0][1] == 8 and piece_new[1][1] == 8 and piece_gone[0][1] == 8 and piece_gone[1][1] == 8:
-            # possibly black castling?
-            if piece_new[0][0] == "c" and piece_new[1][0] == "d" and piece_gone[0][0] == "a" and piece_gone[1][0] == "e":
-                return "e8c8"
-            elif piece_new[1][0] == "c" and piece_new[0][0] == "d" and piece_gone[1][0] == "a" and piece_gone[0][0] == "e":
-                return "e8c8"
-            elif piece_new[0][0] == "g" and piece_new[1][0] == "f" and piece_gone[0][0] == "h" and piece_gone[1][0] == "e":
-                return "e8g8"
-            elif piece_new[1][0] == "g" and piece_new[0][0] == "f" and piece_gone[1][0] == "h" and piece_gone[0][0] == "e":
-                return "e8g8"
-            else:
-                return None
-        else:
-            return None
-
     def getPieceId(self, piece):
         return piece.header.frame_id
 
+class SnapshotBuffer:
+    """
+    Hands boards from the perception thread to the executive. The writer
+    builds a complete new BoardState and then swaps it in with a single
+    reference assignment (atomic in Python), so readers never take a lock
+    and never see a half written board. Each board gets a version number.
+    Published boards must not be modified, take a snapshot() first.
+    """
+
+    def __init__(self):
+        self.latest = (0, None)
+
+    def publish(self, board):
+        """ Make a board visible to readers, returns its version. """
+        version = self.latest[0] + 1
+        self.latest = (version, board)   # the swap
+        return version
+
+    def read(self):
+        """ Get (version, board) of the latest board, board is None if nothing published. """
+        return self.latest
+
 class BoardUpdater:
+    """
+    Turns ChessBoard messages into boards. Runs in the subscriber thread
+    and never touches the executive's board: it compares messages against
+    the board given to request() and publishes accepted boards through
+    self.snapshots.
+    """
+
     def __init__(self, board):
-        self.board = board
+        self.board = board.snapshot()   # what we compare against
+        self.snapshots = SnapshotBuffer()
         self.transform = None
         self.last_capture = None
         self.up_to_date = False # meaning has changed, now tells whether message has been recieved
 
+        # signals waiters when a board is accepted or the wait is cancelled
+        self.condition = threading.Condition()
+        self.cancelled = False
+
+        # work arrays, reused for every message
+        self.max_pieces = 64
+        self.poses = np.zeros((self.max_pieces, BoardState.POSE_SIZE), dtype=np.float32)
+        self.types = np.zeros(self.max_pieces, dtype=np.int8)
+        self.name_ids = np.zeros(self.max_pieces, dtype=np.int16)
+        self.source = np.zeros(64, dtype=np.intp)   # message index of piece on each square
+        self.occupied = np.zeros(64, dtype=bool)
+
+        # move matching: cost of a square that is unexpectedly empty,
+        #   occupied, or the wrong color (perception often misses pieces)
+        self.missing_cost = 0.25
+        self.extra_cost = 1.0
+        self.color_cost = 1.0
+        self.max_cost = 1.5         # largest cost we accept for a move
+        self.min_confidence = 0.8
+        self.sharpness = 4.0        # how fast confidence falls off with cost
+        self.confidence = 0.0       # confidence of the last match
+        self.position = None        # game position (opponent to move), if known
+        self.candidates = None
+        self.candidates_key = None
+
+        # combines several frames before we look at the board
+        self.fusion = BoardFusion()
+        # tells when the opponent has finished moving
+        self.detector = MoveDetector()
+
+        # newest message waiting to be processed by the worker thread
+        self.mailbox = Mailbox()
+        self.worker = None
+
+        # timing of callback, in seconds
+        self.frames = 0
+        self.frame_time = 0.0
+        self.total_frame_time = 0.0
+
+    def readPieces(self, message):
+        """
+        Quantize the pieces in a ChessBoard message to squares. Fills
+        self.occupied and self.source (the first piece seen on each
+        square wins), returns the number of pieces read.
+        """
+        n = len(message.pieces)
+        if n > self.max_pieces:
+            self.max_pieces = n
+            self.poses = np.zeros((n, BoardState.POSE_SIZE), dtype=np.float32)
+            self.types = np.zeros(n, dtype=np.int8)
+            self.name_ids = np.zeros(n, dtype=np.int16)
+        poses = self.poses
+        for i in range(n):
+            piece = message.pieces[i]
+            pos = piece.pose.position
+            rot = piece.pose.orientation
+            poses[i] = (pos.x, pos.y, pos.z, rot.x, rot.y, rot.z, rot.w)
+            self.types[i] = piece.type
+            self.name_ids[i] = self.board.internName(piece.header.frame_id)
+
+        # truncate like int(), then flip if we are black
+        cells = (poses[:n, 0:2] / SQUARE_SIZE).astype(np.int32)
+        if self.board.side == self.board.BLACK:
+            cells = 7 - cells
+        valid = np.all((cells >= 0) & (cells < 8), axis=1)
+        if not valid.all():
+            rospy.logdebug("Ignoring %d pieces off the board" % (n - valid.sum()))
+        order = np.flatnonzero(valid)
+        squares, first = np.unique(cells[order, 1]*8 + cells[order, 0], return_index=True)
+
+        self.occupied.fill(False)
+        self.occupied[squares] = True
+        self.source[squares] = order[first]
+        return n
+
+    def start(self):
+        """ Process messages given to receive() in a worker thread. """
+        self.worker = MailboxWorker(self.mailbox, self.callback)
+        self.worker.start()
+
+    def receive(self, message):
+        """
+        Subscriber callback, just hands the message to the worker thread.
+        If the worker is still busy the older waiting message is dropped.
+        """
+        self.mailbox.put(message)
+
     def callback(self, message):
         """
         Update the board state, given a new ChessBoard message.
         """
         # no need to update if already up to date
-        if self.up_to_date == True:
+        if self.up_to_date == True and not self.detector.active:
             return
 
+        t = time.time()
+        n = self.readPieces(message)
+        self.detector.add(self.occupied, n)
+        if self.up_to_date == False:
+            self.update(message)
+        self.frame_time = time.time() - t
+        self.frames += 1
+        self.total_frame_time += self.frame_time
+        rospy.logdebug("Board update took %.0fus" % (self.frame_time * 1e6))
+
+    def update(self, message):
         # update transform
         self.transform = message.board_to_fixed
 
-        piece_gone  = list()    # locations moved from
-        piece_new   = list()    # locations moved to
-        piece_color = list()    # locations that have changed color
-
-        # process ChessBoard message
-        temp_board = BoardState(self.board.side)
-        for piece in message.pieces:
-            # get col, rank as "x0"
-            if self.board.side == self.board.WHITE or self.board.side == None:
-                col = self.board.getColName(int(piece.pose.position.x/SQUARE_SIZE))
-                rank = int(piece.pose.position.y/SQUARE_SIZE) + 1
-            else:
-                col = self.board.getColName(7 - int(piece.pose.position.x/SQUARE_SIZE))
-                rank = 8 - int(piece.pose.position.y/SQUARE_SIZE)
-            if not self.board.valid(col, rank):
-                print "invalid: ", col, rank
-                continue
-
-            # update temp board
-            if temp_board.getPiece(col, rank) == None:
-                p = self.board.getPiece(col, rank)
-                if p == None and not self.board.side == None:
-                    piece_new.append([col, rank, piece])
-                    rospy.loginfo("Piece moved to: %s%s" % (col,str(rank)))
-                temp_board.setPiece(col, rank, piece)
-
-        # see how board has changed
-        for col in 'abcdefgh':
-            for rank in [1,2,3,4,5,6,7,8]:
-                old = self.board.getPiece(col,rank)
-                new = temp_board.getPiece(col,rank)
-                if new == None and old != None:
-                    # this piece is gone!
-                    piece_gone.append([col, rank, old])
-                    rospy.loginfo("Piece moved from: %s%s" % (col,str(rank)))
-                elif old != None and new != None and new.type/abs(float(new.type)) != old.type/abs(float(old.type)):
-                    # capture!
-                    piece_color.append([col, rank, new])
-                    rospy.loginfo("Piece captured: %s%s" % (col,str(rank)))
-                elif old != None and new != None:
-                    # boring, but update types!
-                    new.type = old.type
-                    new.header.frame_id = old.header.frame_id
-                    temp_board.setPiece(col,rank,new)
-
-        # plausibility test: there can only be one change or new piece
+        # process ChessBoard message (already read by callback)
+        color = np.where(self.occupied, np.sign(self.types[self.source]), 0)
+        if not self.fusion.add(self.occupied, color):
+            rospy.logdebug("Waiting for a stable board (%d frames, confidence %.2f)" %
+                           (self.fusion.count, self.fusion.confidence))
+            return
         if self.board.side == None:
-            temp_board.printBoard()
-            if len(piece_color) + len(piece_new) == 0 and len(piece_gone) == 0:
-                rospy.loginfo("No side set, but we are probably white.")
-                self.board.last_move = "none"
-                return self.setBoard(temp_board)
-
-            elif len(piece_color) >= 32 and len(piece_new) == 0:
-                rospy.loginfo("No side set, but we are probably black.")
-                self.board.last_move = "none"
-                return self.setBoard(temp_board)
-
-            else:
-                rospy.logdebug("Try again, %d" % (len(piece_new) + len(piece_color)))
-                self.board.last_move = "fail"
-                return
-
-        elif len(piece_new) + len(piece_color) != 1:
-            # castling
-            self.board.castling_move = self.board.isCastling(piece_new, piece_color, piece_gone)
-            if self.board.castling_move != None:
-                # castling
-                rospy.loginfo("Castling, %s" % self.board.castling_move)
-
-                m = self.board.castling_move
-                print m
-                #self.copyType(m[0], m[1], m[2], m[3], temp_board)
-                to = ChessPiece()
-                to.type = self.board.side * ChessPiece.BLACK_KING
-                if to.type > 0:
-                    to.header.frame_id = "wking"
-                else:
-                    to.header.frame_id = "bking"
-                temp_board.setPiece(m[2],int(m[3]),to)
-
-                m = castling_extras[m]
-                print m
-                #self.copyType(m[0], m[1], m[2], m[3], temp_board)
-                to = ChessPiece()
-                to.type = self.board.side * ChessPiece.BLACK_ROOK
-                if to.type > 0:
-                    if m[0] == 0:
-                        to.header.frame_id = "wrook0"
-                    else:
-                        to.header.frame_id = "wrook1"
-                else:
-                    if m[0] == 0:
-                        to.header.frame_id = "brook0"
-                    else:
-                        to.header.frame_id = "brook1"
-                temp_board.setPiece(m[2],int(m[3]),to)
-                self.board.previous = [self.board.values, self.board.last_move]
-                self.board.last_move = self.board.castling_move
-                return self.setBoard(temp_board)
-
-            rospy.logdebug("Try again, %d" % (len(piece_new) + len(piece_color)))
-            self.board.last_move = "fail"
+            return self.findSide()
+        return self.findMove()
+
+    def findSide(self):
+        """ Starting position, are we white or black? """
+        src = self.source
+        new_occ = self.occupied
+        new_types = np.where(new_occ, self.types[src], 0)
+        old_types = np.frombuffer(self.board.types, dtype=np.int8)
+        old_ids = np.frombuffer(self.board.ids, dtype=np.int16)
+        old_occ = old_ids != BoardState.EMPTY
+        both = old_occ & new_occ
+        same = both & (np.sign(old_types) == np.sign(new_types))
+        gone = np.count_nonzero(old_occ & ~new_occ)
+        color = np.count_nonzero(both & ~same)
+
+        # boring, but update types!
+        temp_board = BoardState(self.board.side)
+        temp_board.load(new_occ,
+                        np.where(same, old_types, new_types),
+                        np.where(same, old_ids, self.name_ids[src]),
+                        self.poses[src])
+        temp_board.printBoard()
+
+        if color == 0 and gone == 0:
+            rospy.loginfo("No side set, but we are probably white.")
+            temp_board.last_move = "none"
+            return self.setBoard(temp_board)
+        elif color >= 32:
+            rospy.loginfo("No side set, but we are probably black.")
+            temp_board.last_move = "none"
+            return self.setBoard(temp_board)
+        else:
+            rospy.logdebug("Try again, %d" % color)
             return
 
-        # if our pieces are missing, fill them in (bishops!)
+    def getCandidates(self):
+        """
+        Legal opponent moves from the current board, each with the squares
+        it changes as (index, occupied, color). Cached by board hash, as
+        the board doesn't change while we wait for the opponent.
+        """
+        if self.candidates != None and self.candidates_key == self.board.zobrist:
+            return self.candidates
+        position = self.position
+        mover = -self.board.side
+        if position == None or position.placement != self.board.zobrist or \
+           position.turn != (0 if mover > 0 else 1):
+            # no (matching) game record, work it out from the board
+            try:
+                position = Position.fromBoard(self.board, -self.board.side)
+            except ValueError as e:
+                rospy.logwarn("Cannot generate moves: %s" % e)
+                return list()
         candidates = list()
-        for entry in piece_gone:
-            (col, rank, piece) = entry
-            if piece.type/abs(piece.type) == self.board.side:
-                # fill in
-                temp_board.setPiece(col, rank, self.board.getPiece(col,rank))
-            else:
-                candidates.append(entry)
-        if len(candidates) == 0:
-            rospy.loginfo("Try again, no candidates")
-            self.board.last_move = "fail"
+        for m in position.legalMoves():
+            if movePromotion(m) not in (0, QUEEN):
+                continue    # we can't see what a pawn promoted to
+            fr, to, flags = moveFrom(m), moveTo(m), moveFlags(m)
+            changes = [(fr, False, 0), (to, True, mover)]
+            if flags & EN_PASSANT:
+                changes.append((to - 8*mover, False, 0))
+            elif flags & CASTLE:
+                (rfr, rto) = CASTLE_ROOK[to]
+                changes += [(rfr, False, 0), (rto, True, mover)]
+            candidates.append((moveToString(m), changes))
+        self.candidates = candidates
+        self.candidates_key = self.board.zobrist
+        return candidates
+
+    def squareCost(self, exp_occ, exp_color, obs_occ, obs_color):
+        """ Cost of observing a square that we expected to look different. """
+        if exp_occ and not obs_occ:
+            return self.missing_cost
+        elif obs_occ and not exp_occ:
+            return self.extra_cost
+        elif exp_occ and exp_color != obs_color:
+            return self.color_cost
+        return 0.0
+
+    def findMove(self):
+        """
+        Score every legal opponent move (and no move at all) by how well
+        the board it would leave matches what we see, accept the best one
+        if it explains the observation well enough.
+        """
+        src = self.source
+        obs_occ = self.fusion.board_occupied
+        obs_color = self.fusion.board_color
+        old_occ = np.frombuffer(self.board.ids, dtype=np.int16) != BoardState.EMPTY
+        old_color = np.sign(np.frombuffer(self.board.types, dtype=np.int8))
+
+        # cost of "nothing happened"
+        missing = old_occ & ~obs_occ
+        extra = obs_occ & ~old_occ
+        color = old_occ & obs_occ & (old_color != obs_color)
+        base = self.missing_cost * np.count_nonzero(missing) + \
+               self.extra_cost * np.count_nonzero(extra) + \
+               self.color_cost * np.count_nonzero(color)
+        mismatch = np.flatnonzero(missing | extra | color).tolist()
+
+        best, best_cost, costs = None, base, [base]
+        for (move, changes) in self.getCandidates():
+            cost = base
+            for (i, occ, col) in changes:
+                o, c = bool(obs_occ[i]), obs_color[i]
+                if i in mismatch:
+                    cost -= self.squareCost(old_occ[i], old_color[i], o, c)
+                cost += self.squareCost(occ, col, o, c)
+            costs.append(cost)
+            if cost < best_cost:
+                best, best_cost = move, cost
+        # how much more likely is the best explanation than the others
+        self.confidence = 1.0 / np.sum(np.exp(-self.sharpness * (np.array(costs) - best_cost)))
+
+        if best == None:
+            rospy.logdebug("Try again, no move seen (%d squares differ)" % len(mismatch))
             return
-        if len(candidates) > 1: # too many possibilities (added 3AM on Wednesday!)
-            rospy.loginfo("Try again, too many candidates %d" % len(candidates))
-            self.board.last_move = "fail"
+        if best_cost > self.max_cost or self.confidence < self.min_confidence:
+            rospy.loginfo("Try again, best move %s has cost %.2f, confidence %.2f" % (best, best_cost, self.confidence))
             return
+        rospy.loginfo("Opponent moved %s (cost %.2f, confidence %.2f)" % (best, best_cost, self.confidence))
 
-        # find the corresponding piece
-        if len(piece_new) == 1:
-            piece_to = piece_new[0]
-        else:
-            # remove the old piece from the planning scene
-            self.last_capture = self.board.getPieceId(self.board.getPiece(piece_color[0][0],piece_color[0][1]))
-            piece_to = piece_color[0]
-        piece_fr = candidates[0]
-        # update type
-        self.board.copyType(piece_fr[0], piece_fr[1], piece_to[0], piece_to[1], temp_board)
+        # remove the captured piece from the planning scene
+        (col_f, rank_f) = self.board.toPosition(best[0:2])
+        (col_t, rank_t) = self.board.toPosition(best[2:4])
+        self.last_capture = None
+        captured = self.board.getPiece(col_t, rank_t)
+        if captured == None and self.board.getPieceType(col_f, rank_f) in (ChessPiece.WHITE_PAWN, ChessPiece.BLACK_PAWN) \
+                and col_f != col_t:
+            captured = self.board.getPiece(col_t, rank_f)   # en passant
+        if captured != None:
+            self.last_capture = self.board.getPieceId(captured)
+
+        # apply the move to our board, then take poses of pieces we can see
+        temp_board = self.board.snapshot()
+        temp_board.applyMove(best)
+        occ = np.frombuffer(temp_board.ids, dtype=np.int16) != BoardState.EMPTY
+        seen = occ & self.occupied  # in the latest frame
+        poses = np.frombuffer(temp_board.poses, dtype=np.float32).reshape(64, BoardState.POSE_SIZE)
+        temp_board.load(occ,
+                        np.frombuffer(temp_board.types, dtype=np.int8),
+                        np.frombuffer(temp_board.ids, dtype=np.int16),
+                        np.where(seen[:, None], self.poses[src], poses))
 
         # set outputs
-        self.board.previous = [self.board.values, self.board.last_move]
-        self.board.last_move = piece_fr[0] + str(piece_fr[1]) + piece_to[0] + str(piece_to[1])
+        temp_board.castling_move = best if best in castling_extras.keys() and \
+            abs(self.board.getPieceType(col_f, rank_f)) == ChessPiece.WHITE_KING else None
+        temp_board.previous = self.board
+        temp_board.last_move = best
         return self.setBoard(temp_board)
 
     def setBoard(self, temp_board):
-        # patch board
-        self.board.values = temp_board.values
+        # publish board
+        self.fusion.reset()
         #if self.board.output:
         #    temp_board.printBoard()
-        self.up_to_date = True
+        self.snapshots.publish(temp_board)
+        with self.condition:
+            self.up_to_date = True
+            self.condition.notify_all()
+
+    def request(self, board=None):
+        """
+        Ask for a new board, see waitForBoard(). If given, board is the
+        current state of the game that we look for changes from.
+        """
+        if board != None:
+            self.board = board.snapshot()
+        with self.condition:
+            self.up_to_date = False
+
+    def waitForBoard(self, timeout=None):
+        """
+        Block until a board is accepted, the wait is cancelled or timeout
+        seconds have passed. Returns True if a board was accepted.
+        """
+        timer = None
+        deadline = None
+        if timeout != None:
+            # wake ourselves at the deadline, untimed waits return as soon as notified
+            deadline = time.time() + timeout
+            timer = threading.Timer(timeout, self.wake)
+            timer.daemon = True
+            timer.start()
+        with self.condition:
+            while not self.up_to_date and not self.cancelled:
+                if deadline != None and time.time() >= deadline - 0.001:
+                    break
+                self.condition.wait()
+            result = self.up_to_date
+        if timer != None:
+            timer.cancel()
+        return result
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def cancel(self):
+        """ Stop all waiting, for instance on shutdown. """
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+        self.detector.cancel()
+        self.mailbox.close()
 
 ###########################################################
 # chess engine logic
 class GnuChessEngine:
-    """ Connection to a GNU chess engine. """
-
-    def __init__(self):
+    """
+    Connection to a GNU chess engine. Requests are answered with a
+    MoveFuture by a worker thread, and while the opponent thinks the
+    engine can ponder on the reply it expects. Given an EnginePool, the
+    game is played on the pool's shared engines instead of its own. Given
+    a RemoteEnginePool, moves are searched on another machine, and if
+    it fails to answer the game carries on with a local engine. Given
+    a MoveCache, positions seen before are answered from the cache. The
+    engine gets timeout seconds per move, if it fails to answer it is
+    restarted and the built in search plays that move instead. Without
+    gnuchess (or with use_gnuchess False) the built in search plays
+    every move. Cached answers are only used if they are at least
+    cache_strength strong (seconds of gnuchess thinking), unless the
+    built in search would answer anyways. A TimeManager sets how long to think about each move,
+    and positions with only one legal move are answered right away, as
+    are endgames covered by a TablebaseProber. Given a MoveCostModel, the
+    engine's move is swapped for one the arm can make more quickly if the
+    built in search, looking at least cost_depth plies ahead, scores both
+    within cost_margin centipawns of the best move it found. That search
+    takes cost_budget seconds of each turn, and the engine thinks that
+    much less.
+    """
+
+    def __init__(self, ponder=True, pool=None, cache=None, timeout=None, use_gnuchess=True,
+                 time_manager=None, tablebase=None, cost_model=None, cost_margin=25,
+                 cost_candidates=4, cost_budget=1.0, cost_depth=4, cache_strength=1.0):
         """
         Start a connection to GNU chess.
         """
-        self.engine = pexpect.spawn('/usr/games/gnuchess -x')
+        self.pool = pool
+        self.tablebase = tablebase
+        self.cost_model = cost_model
+        self.cost_margin = cost_margin
+        self.cost_candidates = cost_candidates
+        self.cost_budget = cost_budget
+        self.cost_depth = cost_depth
+        self.timeout = timeout
+        self.time_manager = time_manager
+        self.think_time = None  # seconds, None to leave it to the engine
+        self.search = SearchEngine()
+        self.use_gnuchess = use_gnuchess
+        self.engine = None
+        if pool != None:
+            try:
+                self.session = pool.newSession()
+            except EngineError as e:
+                rospy.logerr("Unable to use engine pool (%s), playing locally" % e)
+                self.pool = pool = None
+        if pool == None:
+            self.startEngine()
+            if self.engine == None:
+                ponder = False
+        else:
+            ponder = False  # pooled engines don't keep our game around
+        self.cache = cache
+        self.cache_strength = cache_strength
         self.history = list()
         self.pawning = False
+        # mirror of the engine's game, used to reject illegal moves locally
+        self.position = Position.initial()
+        # pondering: (predicted move, future of our reply to it)
+        self.ponder_enabled = ponder
+        self.pondering = None
+        self.ponder_hits = 0
+        self.ponder_misses = 0
+        self.lock = threading.Lock()
+        self.worker = EngineWorker()
+        self.worker.start()
         #self.nextMove = self.nextMoveUser
         self.nextMove = self.nextMoveGNU
 
+    def startEngine(self):
+        """ Start our own gnuchess, if we are allowed to. """
+        if not self.use_gnuchess:
+            return
+        try:
+            self.engine = EngineProcess()
+            self.engine.send('easy')    # we do our own pondering
+        except (OSError, EngineError) as e:
+            rospy.logerr("Unable to start gnuchess (%s), using built in search" % e)
+            self.engine = None
+
+    def goLocal(self):
+        """ Stop using a remote pool, and set up our own engine with our copy of the game. """
+        self.pool.closeSession(self.session)
+        self.pool = None
+        self.startEngine()
+        if self.engine != None and self.position != None:
+            self.engine.setBoard(self.position.toFen())
+
     def startNewGame(self):
-        self.engine.sendline('new')
+        self.worker.submit(self.resetGame)
+
+    def resetGame(self):
+        self.dropPonder()
+        if self.engine != None:
+            self.engine.newGame()
         self.history = list()
+        self.position = Position.initial()
+
+    def isLegal(self, move):
+        """ Check an opponent move against our copy of the game. """
+        if self.position == None or not isMoveString(move):
+            return True # can't tell, let the engine decide
+        return self.position.isLegal(move)
+
+    def pushMove(self, move):
+        """ Keep our copy of the game in step with the engine. """
+        if self.position == None or not isMoveString(move):
+            return
+        if not self.position.pushString(move):
+            rospy.logwarn("Lost track of game at %s, no longer checking moves locally" % move)
+            self.position = None
 
     def nextMoveGNU(self, move="go", board=None):
         """
         Give opponent's move, get back move to make.
             returns None if given an invalid move.
         """
+        return self.requestMove(move, board).result()
+
+    def requestMove(self, move="go", board=None):
+        """
+        Give opponent's move, returns a MoveFuture for the move to make.
+        """
+        future = MoveFuture()
+        with self.lock:
+            if self.pondering != None and self.pondering[0] != move and not self.pondering[1].done():
+                self.engine.moveNow()   # wrong guess, have the engine move now
+        self.worker.submit(self.play, move, board, future)
+        return future
+
+    def ponder(self):
+        """
+        Start thinking about our reply to the opponent's most likely move,
+        call once our own move has been decided.
+        """
+        if self.ponder_enabled and not self.pawning:
+            self.worker.submit(self.startPonder)
+
+    def whenPondered(self, callback):
+        """
+        Call callback(predicted, reply) once pondering has found our reply
+        to the move we expect. False if we are not pondering (yet).
+        """
+        with self.lock:
+            pondering = self.pondering
+        if pondering == None:
+            return False
+        (predicted, future) = pondering
+        future.addDoneCallback(lambda f: f.move != None and callback(predicted, f.move))
+        return True
+
+    def startPonder(self):
+        predicted = self.engine.hint()
+        if predicted == None or self.position == None or not self.position.isLegal(predicted):
+            return
+        future = MoveFuture()
+        with self.lock:
+            self.pondering = (predicted, future)
+        try:
+            future.setResult(self.think(predicted))
+        except EngineError as e:
+            rospy.logwarn("Engine failed while pondering: %s" % e)
+            future.setResult(None)
+            self.recover()
+
+    def dropPonder(self):
+        """ Forget about pondering, take back the predicted move and reply. """
+        with self.lock:
+            pondering = self.pondering
+            self.pondering = None
+        if pondering != None and pondering[1].result() != None:
+            self.engine.send('remove')
+        return pondering
+
+    def play(self, move, board, future):
+        try:
+            future.setResult(self.findMove(move, board, future))
+        except Exception as e:
+            rospy.logerr("Engine failed: %s" % e)
+            future.setResult(None)
+
+    def findMove(self, move, board, future):
+        if not self.isLegal(move):
+            rospy.loginfo("Illegal move %s" % move)
+            self.dropPonder()
+            return None
+        # did we ponder on this move?
+        with self.lock:
+            pondering = self.pondering
+        if pondering != None and pondering[0] == move and not self.pawning:
+            with self.lock:
+                self.pondering = None
+            m = pondering[1].result()
+            if m != None:
+                self.ponder_hits += 1
+                future.ponder_hit = True
+                rospy.loginfo("Ponder hit on %s" % move)
+                self.pushMove(move)
+                if self.cache != None and self.position != None:
+                    self.cache.put(self.position.fenKey(), m, self.answerStrength())
+                cheaper = self.cheaperMove(m)
+                if cheaper != m:
+                    self.engine.replaceLast(cheaper)
+                    m = cheaper
+                self.history.append(m)
+                self.pushMove(m)
+                return m
+        if self.dropPonder() != None:
+            self.ponder_misses += 1
+        self.pushMove(move)
         # get move
         if self.pawning:
-            while not rospy.is_shutdown():
-                rows = [2,3,4,5]
-                piece = ChessPiece.WHITE_PAWN
-                if board.side == board.BLACK:
-                    rows = [7,6,5,4]
-                    piece = ChessPiece.BLACK_PAWN
-                for row in rows:
-                    for col in ['a','b','c','d','e','f','g','h']:
-                        p1 = board.getPiece(col,row)
-                        if p1 != None and abs(p1.type) == piece:
-                            p2 = board.getPiece(col,row+1)
-                            if p2 == None:
-                                # this is a candidate
-                                m = col + str(row) + col + str(row+1)
-                                self.history.append(m)
-                                return m
+            # our game may not match the board anymore, go by the board
+            m = self.fallbackMove(board)
+            if m == None:
+                return None
         else:
-            self.engine.sendline(move)
-            if self.engine.expect(['My move is','Illegal move']) == 1:
+            key = None
+            if self.position != None:
+                legal = self.position.legalMoves()
+                if len(legal) == 1:
+                    m = moveToString(legal[0])
+                    rospy.loginfo("Only one legal move, %s" % m)
+                    future.forced = True
+                    return self.playWithoutEngine(move, m)
+            if self.tablebase != None and self.position != None:
+                m = self.tablebase.bestMove(self.position)
+                if m != None:
+                    rospy.loginfo("Tablebase move %s" % m)
+                    future.tablebase_hit = True
+                    return self.playWithoutEngine(move, m)
+            if self.cache != None and self.position != None:
+                key = self.position.fenKey()
+                m = self.cache.get(key, self.wantedStrength())
+                if m != None and self.position.isLegal(m):
+                    future.cache_hit = True
+                    return self.playWithoutEngine(move, self.cheaperMove(m))
+            if self.time_manager != None:
+                reserve = 0.0
+                if self.cost_model != None:
+                    reserve = self.cost_budget    # for cheaperMove()
+                self.think_time = self.time_manager.budget(reserve)
+            try:
+                start = time.time()
+                m = self.think(move)
+                if self.time_manager != None:
+                    self.time_manager.recordEngine(time.time() - start, self.think_time)
+            except EngineError as e:
+                rospy.logerr("No answer from engine: %s" % e)
+                m = self.fallbackMove(board)
+                if m != None:
+                    self.history.append(m)
+                    self.pushMove(m)
+                self.recover()
+                return m
+            if m == None:
+                if self.position != None and isMoveString(move):
+                    self.position.pop()  # engine disagrees, take it back
                 return None
-            self.engine.expect('([a-h][1-8][a-h][1-8][RrNnBbQq(\r\n)])')
-            m = self.engine.after.rstrip()
+            if key != None:
+                self.cache.put(key, m, self.answerStrength())
+            cheaper = self.cheaperMove(m)
+            if cheaper != m:
+                if self.engine != None:
+                    self.engine.replaceLast(cheaper)
+                m = cheaper
         self.history.append(m)
+        self.pushMove(m)
         return m
 
+    def answerStrength(self):
+        """ Strength of the answer just found, for the cache. """
+        if self.pool == None and self.engine == None:
+            return self.search.depth * SEARCH_STRENGTH
+        if self.think_time == None:
+            return self.cache_strength  # engine's own time control
+        return self.think_time
+
+    def wantedStrength(self):
+        """ Strength a cached answer needs, to be played instead of searching. """
+        if self.pool == None and self.engine == None:
+            return 0.0  # anything beats the built in search
+        return self.cache_strength
+
+    def cheaperMove(self, m):
+        """ The move the arm can make fastest, of those about as good as m. """
+        if self.cost_model == None or self.position == None:
+            return m
+        ranked = self.search.rankMoves(self.position, self.cost_candidates, self.cost_budget, m)
+        scores = dict(ranked)
+        if m not in scores or self.search.depth < self.cost_depth:
+            return m    # too shallow to second guess the engine
+        good_enough = ranked[0][1] - self.cost_margin
+        if scores[m] < good_enough:
+            return m    # searches disagree, trust the engine
+        best, best_cost = m, self.cost_model.estimate(self.position, self.position.parseMove(m))
+        for (candidate, score) in ranked:
+            if score < good_enough:
+                continue
+            cost = self.cost_model.estimate(self.position, self.position.parseMove(candidate))
+            if cost < best_cost:
+                best, best_cost = candidate, cost
+        if best != m:
+            rospy.loginfo("Playing %s instead of %s, scores %d vs %d, about %.0fs quicker" %
+                          (best, m, scores[best], scores[m],
+                           self.cost_model.estimate(self.position, self.position.parseMove(m)) - best_cost))
+        return best
+
+    def playWithoutEngine(self, move, m):
+        """ Play a move we found without asking the engine. """
+        if self.engine != None:
+            # engine still has to see the moves
+            self.engine.force([x for x in (move, m) if isMoveString(x)])
+        self.history.append(m)
+        self.pushMove(m)
+        return m
+
+    def think(self, move):
+        """
+        Send a move (or go) to the engine and read its reply, None if illegal.
+        Raises EngineError if the engine fails to answer.
+        """
+        if self.pool == None:
+            if self.engine == None:
+                if self.position == None:
+                    raise EngineError("lost track of game, can't search")
+                return self.search.bestMove(self.position, self.think_time)
+            if self.think_time != None:
+                self.engine.setThinkTime(self.think_time)
+            return self.engine.think(move, self.timeout)
+        # pooled engines are given the whole position, move is already in it
+        if self.position == None:
+            raise EngineError("lost track of game, can't ask the engine pool")
+        future = self.pool.think(self.session, self.position.toFen(), self.timeout, self.think_time)
+        m = future.result()
+        if future.error != None:
+            if isinstance(self.pool, RemoteEnginePool):
+                rospy.logerr("Remote engine failed (%s), playing locally from now on" % future.error)
+                self.goLocal()
+                return self.think('go')
+            raise EngineError(future.error)
+        return m
+
+    def recover(self):
+        """ Replace a failed engine, and set it up with our copy of the game. """
+        if self.engine == None:
+            return  # the pool replaces its own engines, search has none
+        self.engine.restart()
+        self.engine.send('easy')
+        if self.position != None:
+            self.engine.setBoard(self.position.toFen())
+        else:
+            rospy.logwarn("Lost track of game, restarted engine starts from scratch")
+
+    def fallbackMove(self, board):
+        """ A move found by the built in search from the board, for when we can't ask the engine. """
+        try:
+            m = self.search.nextMove(board.last_move, board)
+            rospy.loginfo("Search found %s (depth %d, score %d, %d nodes in %.2fs)" %
+                          (m, self.search.depth, self.search.score, self.search.nodes, self.search.elapsed))
+            return m
+        except ValueError as e:
+            rospy.logwarn("Can't search this board (%s), pushing a pawn" % e)
+            return self.pawnMove(board)
+
+    def pawnMove(self, board):
+        """ Push a pawn, last resort when we can't search the board either. """
+        rows = [2,3,4,5]
+        piece = ChessPiece.WHITE_PAWN
+        if board.side == board.BLACK:
+            rows = [7,6,5,4]
+            piece = ChessPiece.BLACK_PAWN
+        for row in rows:
+            for col in ['a','b','c','d','e','f','g','h']:
+                p1 = board.getPiece(col,row)
+                if p1 != None and abs(p1.type) == piece:
+                    p2 = board.getPiece(col,row+1)
+                    if p2 == None:
+                        # this is a candidate
+                        return col + str(row) + col + str(row+1)
+        return None
+
     def nextMoveUser(self, move="go", board=None):
         print "Please enter a move"
         return raw_input().rstrip()
@@ -592,17 +1355,217 @@ class GnuChessEngine:
         print "game review:"
         for h in self.history:
             print h
-        self.engine.sendline('exit')
+        print "ponder hits: %d, misses: %d" % (self.ponder_hits, self.ponder_misses)
+        if self.cache != None:
+            print "cache:", self.cache.getStats()
+            self.cache.sync()
+        if self.time_manager != None:
+            print "time:", self.time_manager.getStats()
+        if self.tablebase != None:
+            print "tablebase:", self.tablebase.getStats()
+        self.worker.close()
+        if self.pool != None:
+            self.pool.closeSession(self.session)
+        elif self.engine != None:
+            print "engine:", self.engine.getStats()
+            self.engine.exit()
+
+class SceneMirror:
+    """
+    What the planning scene holds, as far as we know: for each collision
+    object its shape, dimensions, position and color. diff() compares the
+    objects we want against it, so only objects that were added, moved
+    (by more than tolerance meters) or changed have to be sent, and only
+    those that went away removed.
+    """
+
+    def __init__(self, tolerance=0.003):
+        self.tolerance = tolerance
+        self.objects = dict()   # name -> (shape, dimensions, position, color)
+
+    def diff(self, objects):
+        """ Names to add or update, and names to remove, to get to objects. """
+        changed = list()
+        for (name, (shape, dimensions, position, color)) in objects.items():
+            known = self.objects.get(name)
+            if known == None or known[0] != shape or known[1] != dimensions or known[3] != color or \
+               max([abs(a - b) for (a, b) in zip(known[2], position)]) > self.tolerance:
+                changed.append(name)
+        removed = [name for name in self.objects.keys() if name not in objects]
+        return (changed, removed)
+
+    def apply(self, objects, changed, removed):
+        """ The scene has been sent a diff. """
+        for name in changed:
+            self.objects[name] = objects[name]
+        for name in removed:
+            self.objects.pop(name, None)
+
+    def forget(self, name):
+        """ Something else changed this object (say, the arm moved it). """
+        self.objects.pop(name, None)
+
+    def clear(self):
+        self.objects = dict()
+
+class GraspStats:
+    """
+    How often each grasp (or place) candidate worked, for each square and
+    piece type, kept in a shelve file between runs (path None to keep
+    them in memory). Candidates are ranked by their success rate, starting
+    from their prior and weighted by prior_weight tries. Candidates that
+    have been tried prune_after times without ever working are left out,
+    unless we are desperate, but at least min_keep are always tried.
+    Results count for half as much every half_life seconds, so candidates
+    that failed for a while get tried again.
+    """
+
+    def __init__(self, path=None, prior_weight=2.0, prune_after=5, min_keep=5, half_life=7*24*3600.0):
+        self.lock = threading.Lock()
+        self.prior_weight = prior_weight
+        self.prune_after = prune_after
+        self.min_keep = min_keep
+        self.half_life = half_life
+        self.table = dict()     # 'kind square piece' -> {candidate: [wins, tries, time]}
+        self.disk = None
+        if path != None:
+            self.disk = shelve.open(path)
+            self.table.update(self.disk)
+        # statistics
+        self.pruned = 0
+
+    def key(self, kind, square, piece_type):
+        return '%s %s %d' % (kind, square, abs(piece_type))
+
+    def counts(self, key):
+        """ {candidate: (wins, tries)} for a key, as they count now. """
+        now = time.time()
+        counts = dict()
+        for (name, entry) in self.table.get(key, dict()).items():
+            stamp = now
+            if len(entry) > 2:
+                stamp = entry[2]    # older files have no time
+            weight = 0.5 ** (max(now - stamp, 0.0) / self.half_life)
+            counts[name] = (entry[0] * weight, entry[1] * weight)
+        return counts
+
+    def score(self, counts, name):
+        (wins, tries) = counts.get(name, (0, 0))
+        return (wins + self.prior_weight * CANDIDATE_PRIOR.get(name, 0.5)) / (tries + self.prior_weight)
+
+    def order(self, key, candidates, prune=True):
+        """ Candidates, most likely to work first. Returns a new list, and their scores. """
+        with self.lock:
+            counts = self.counts(key)
+            ranked = sorted(candidates, key=lambda c: -self.score(counts, c.id))
+            if prune:
+                kept = [c for c in ranked if counts.get(c.id, (0, 0))[0] > 0 or
+                                             counts.get(c.id, (0, 0))[1] < self.prune_after]
+                if len(kept) < self.min_keep:
+                    kept = ranked[0:max(self.min_keep, len(kept))]
+                self.pruned += len(ranked) - len(kept)
+                ranked = kept
+            return ranked, [self.score(counts, c.id) for c in ranked]
+
+    def record(self, key, candidates, winner=None):
+        """
+        A pick or place was planned with candidates, in the order they were
+        tried: winner is the id of the one that worked, None if none did.
+        """
+        with self.lock:
+            names = [c.id for c in candidates]
+            if winner != None:
+                if winner not in names:
+                    return  # can't tell which one worked
+                # those ahead of the winner were tried, and didn't work
+                tried = [(name, 1.0) for name in names[0:names.index(winner) + 1]]
+            else:
+                # could well be the scene rather than the candidates, they share one try
+                tried = [(name, 1.0 / len(names)) for name in names]
+            counts = self.counts(key)
+            entries = self.table.setdefault(key, dict())
+            now = time.time()
+            for (name, weight) in tried:
+                (wins, tries) = counts.get(name, (0.0, 0.0))
+                entries[name] = [wins + (name == winner), tries + weight, now]
+            if self.disk != None:
+                self.disk[key] = entries
+
+    def ranking(self, kind, square, piece_type):
+        """ (candidate, wins, tries) for a square and piece type, best first, for inspection. """
+        with self.lock:
+            counts = self.counts(self.key(kind, square, piece_type))
+            names = sorted(counts.keys(), key=lambda n: -self.score(counts, n))
+            return [(n, counts[n][0], counts[n][1]) for n in names]
+
+    def getStats(self):
+        with self.lock:
+            wins = sum([e[0] for entries in self.table.values() for e in entries.values()])
+            tries = sum([e[1] for entries in self.table.values() for e in entries.values()])
+            return { 'keys': len(self.table),
+                     'wins': wins,
+                     'tries': tries,
+                     'success_rate': float(wins) / max(tries, 1),
+                     'pruned': self.pruned }
+
+    def close(self):
+        with self.lock:
+            if self.disk != None:
+                self.disk.close()
+                self.disk = None
+
+class ArmSegment:
+    """
+    One piece the arm moves as part of a move: a captured piece going off
+    the board ('capture'), the piece that moves ('move'), or the rook when
+    castling ('castle'). Poses are in FIXED_FRAME, start_square and
+    end_square are named as the robot sees them, square as in the move.
+    """
+
+    def __init__(self, role, name, piece_type, start_pose, end_pose, start_square, end_square, square):
+        self.role = role
+        self.name = name
+        self.piece_type = piece_type
+        self.start_pose = start_pose
+        self.end_pose = end_pose
+        self.start_square = start_square
+        self.end_square = end_square
+        self.square = square
 
 class ChessArmPlanner(Thread):
 
     CHESS_BOARD_FRAME = 'chess_board'
 
+    # candidate orientations, indexed by mega_angle. Grasps come from above, places are in the object frame
+    GRASP_ORIENTATIONS = dict((mega, orientationTable([1.57 - p for p in pitches], GRASP_YAWS).tolist())
+                              for (mega, pitches) in [(False, GRASP_PITCHES), (True, MEGA_PITCHES)])
+    GRASP_QUALITY = dict((mega, [1.0 - abs(p/2.0) for y in GRASP_YAWS for p in pitches])
+                         for (mega, pitches) in [(False, GRASP_PITCHES), (True, MEGA_PITCHES)])
+    PLACE_ORIENTATIONS = dict((mega, orientationTable(pitches, GRASP_YAWS).tolist())
+                              for (mega, pitches) in [(False, GRASP_PITCHES), (True, MEGA_PITCHES)])
+
     """ Chess-specific stuff """
-    def __init__(self, listener = None):
+    def __init__(self, listener = None, grasp_stats = None, retry_budget = 60.0, widen_after = 15.0, ahead_wait = 0.25):
         Thread.__init__(self)
+        # which grasps and places work where, and seconds to keep trying a pick or place
+        self.grasp_stats = grasp_stats
+        if self.grasp_stats == None:
+            self.grasp_stats = GraspStats()
+        self.retry_budget = retry_budget
+        self.widen_after = widen_after  # then try wider angles, and those that never worked
+        # picks planned ahead while the opponent thinks: (board zobrist, move) -> {piece: grasp id}
+        self.pre_plans = dict()
+        self.pre_grasps = dict()    # for the move being executed
+        self.generation = 0         # moves executed, stale speculation gives up
+        self.busy = threading.Lock()
+        self.speculator = EngineWorker()
+        self.speculator.start()
+        self.ahead_wait = ahead_wait    # seconds a pick planned during a place may hold up the move
+        self.speculation = { 'planned' : 0, 'used' : 0, 'stale' : 0, 'ahead' : 0, 'discarded' : 0, 'late' : 0 }
         self._grasp = PickPlaceInterface(GROUP_NAME_ARM, GROUP_NAME_GRIPPER)
         self._obj = PlanningSceneInterface(FIXED_FRAME)
+        self._apply_scene = rospy.ServiceProxy('apply_planning_scene', ApplyPlanningScene)
+        self.scene = SceneMirror()
         self._listener = listener
         if self._listener == None:
             self._listener = TransformListener()
@@ -610,6 +1573,24 @@ class ChessArmPlanner(Thread):
         self._move = MoveGroupInterface(GROUP_NAME_ARM, FIXED_FRAME, self._listener)
         self.success = True
         self.transform = None
+        # parts of grasps and places that are the same for every candidate
+        self.grasp_template = Grasp()
+        self.grasp_template.pre_grasp_posture = self.make_gripper_posture(GRIPPER_OPEN)
+        self.grasp_template.grasp_posture = self.make_gripper_posture(GRIPPER_CLOSED)
+        self.grasp_template.pre_grasp_approach = self.make_gripper_translation(0.1, 0.15)
+        self.grasp_template.post_grasp_retreat = self.make_gripper_translation(0.1, 0.15, -1.0)
+        self.place_template = PlaceLocation()
+        self.place_template.post_place_posture = self.make_gripper_posture(GRIPPER_OPEN)
+        self.place_template.pre_place_approach = self.make_gripper_translation(0.1, 0.15)
+        self.place_template.post_place_retreat = self.make_gripper_translation(0.1, 0.15, -1.0)
+        # candidates for the last few poses, reused when a pick or place is retried
+        self.candidates = OrderedDict()
+        # board transform and its matrix, poses transformed with it and those left to tf
+        self.matrix = None
+        self.batched_poses = 0
+        self.tf_fallbacks = 0
+        # seconds taken by each part of executing moves
+        self.timing = { 'scene' : list(), 'pick_place' : list(), 'tuck' : list() }
 
     def run(self):
         while not rospy.is_shutdown():
@@ -628,12 +1609,33 @@ class ChessArmPlanner(Thread):
                                                 "base_link")
             rospy.sleep(0.1)
 
+    def transform_poses(self, poses):
+        """
+        Map an N x 7 array of chess board frame poses to FIXED_FRAME in one
+        go, with the board transform from perception. None if we have none.
+        """
+        if self.transform == None:
+            return None
+        if self.matrix == None or self.matrix[0] is not self.transform:
+            self.matrix = (self.transform, transformMatrix(self.transform.transform))
+        self.batched_poses += len(poses)
+        return transformPoses(self.transform.transform, poses, self.matrix[1])
+
     def transform_pose(self, pose):
-        if self.transform:
-            # TODO transform manually
-            return self._listener.transformPose(FIXED_FRAME, pose)
-        else:
-            return self._listener.transformPose(FIXED_FRAME, pose)
+        if pose.header.frame_id == self.CHESS_BOARD_FRAME:
+            p = pose.pose
+            out = self.transform_poses([[p.position.x, p.position.y, p.position.z, p.orientation.x,
+                                         p.orientation.y, p.orientation.z, p.orientation.w]])
+            if out is not None:
+                pt = PoseStamped()
+                pt.header.stamp = pose.header.stamp
+                pt.header.frame_id = FIXED_FRAME
+                (pt.pose.position.x, pt.pose.position.y, pt.pose.position.z, pt.pose.orientation.x,
+                 pt.pose.orientation.y, pt.pose.orientation.z, pt.pose.orientation.w) = out[0].tolist()
+                return pt
+        # no board transform yet, ask tf
+        self.tf_fallbacks += 1
+        return self._listener.transformPose(FIXED_FRAME, pose)
 
     # Get the gripper posture as a JointTrajectory
     def make_gripper_posture(self, pose):
@@ -653,128 +1655,259 @@ class ChessArmPlanner(Thread):
         g.desired_distance = desired
         return g
 
+    def oriented_pose(self, pose_stamped, q):
+        """ Pose at the same position, with orientation q. Header and position are shared. """
+        p = PoseStamped()
+        p.header = pose_stamped.header
+        p.pose.position = pose_stamped.pose.position
+        p.pose.orientation.x, p.pose.orientation.y, p.pose.orientation.z, p.pose.orientation.w = q
+        return p
+
+    def cached_candidates(self, kind, pose_stamped, mega_angle, make):
+        p = pose_stamped.pose.position
+        key = (kind, pose_stamped.header.frame_id, round(p.x, 4), round(p.y, 4), round(p.z, 4), mega_angle)
+        if key in self.candidates:
+            candidates = self.candidates.pop(key)
+        else:
+            candidates = make()
+        self.candidates[key] = candidates
+        while len(self.candidates) > 8:
+            self.candidates.popitem(last=False)
+        return candidates
+
     def make_grasps(self, pose_stamped, mega_angle=False):
-        # setup defaults of grasp
-        g = Grasp()
-        g.pre_grasp_posture = self.make_gripper_posture(GRIPPER_OPEN)
-        g.grasp_posture = self.make_gripper_posture(GRIPPER_CLOSED)
-        g.pre_grasp_approach = self.make_gripper_translation(0.1, 0.15)
-        g.post_grasp_retreat = self.make_gripper_translation(0.1, 0.15, -1.0)
-        g.grasp_pose = pose_stamped
-
-        pitch_vals = [0, 0.2, -0.2, 0.4, -0.4]
-        if mega_angle:
-            pitch_vals += [0.3, -0.3, 0.5, -0.5, 0.6, -0.6]
-
-        # generate list of grasps
-        grasps = []
-        for y in [-1.57, -0.78, 0, 0.78, 1.57]:
-            for p in pitch_vals:
-                q = quaternion_from_euler(0, 1.57-p, y)
-                g.grasp_pose.pose.orientation.x = q[0]
-                g.grasp_pose.pose.orientation.y = q[1]
-                g.grasp_pose.pose.orientation.z = q[2]
-                g.grasp_pose.pose.orientation.w = q[3]
-                g.id = str(len(grasps))
-                g.grasp_quality = 1.0 - abs(p/2.0)
-                grasps.append(copy.deepcopy(g))
-        return grasps
+        def make():
+            t = self.grasp_template
+            grasps = []
+            for i, q in enumerate(self.GRASP_ORIENTATIONS[mega_angle]):
+                g = Grasp()
+                g.id = CANDIDATE_NAMES[mega_angle][i]
+                g.pre_grasp_posture = t.pre_grasp_posture
+                g.grasp_posture = t.grasp_posture
+                g.pre_grasp_approach = t.pre_grasp_approach
+                g.post_grasp_retreat = t.post_grasp_retreat
+                g.grasp_pose = self.oriented_pose(pose_stamped, q)
+                g.grasp_quality = self.GRASP_QUALITY[mega_angle][i]
+                grasps.append(g)
+            return grasps
+        return self.cached_candidates('grasp', pose_stamped, mega_angle, make)
 
     def make_places(self, pose_stamped, mega_angle=False):
-        # setup default of place location
-        l = PlaceLocation()
-        l.post_place_posture = self.make_gripper_posture(GRIPPER_OPEN)
-        l.pre_place_approach = self.make_gripper_translation(0.1, 0.15)
-        l.post_place_retreat = self.make_gripper_translation(0.1, 0.15, -1.0)
-        l.place_pose = pose_stamped
-
-        pitch_vals = [0, 0.2, -0.2, 0.4, -0.4]
-        if mega_angle:
-            pitch_vals += [0.3, -0.3, 0.5, -0.5, 0.6, -0.6]
-
-        # generate list of place locations
-        places = []
-        for y in [-1.57, -0.78, 0, 0.78, 1.57]:
-            for p in pitch_vals:
-                q = quaternion_from_euler(0, p, y)  # now in object frame
-                l.place_pose.pose.orientation.x = q[0]
-                l.place_pose.pose.orientation.y = q[1]
-                l.place_pose.pose.orientation.z = q[2]
-                l.place_pose.pose.orientation.w = q[3]
-                l.id = str(len(places))
-                places.append(copy.deepcopy(l))
-        return places
+        def make():
+            t = self.place_template
+            places = []
+            for i, q in enumerate(self.PLACE_ORIENTATIONS[mega_angle]):
+                l = PlaceLocation()
+                l.id = CANDIDATE_NAMES[mega_angle][i]
+                l.post_place_posture = t.post_place_posture
+                l.pre_place_approach = t.pre_place_approach
+                l.post_place_retreat = t.post_place_retreat
+                l.place_pose = self.oriented_pose(pose_stamped, q)
+                places.append(l)
+            return places
+        return self.cached_candidates('place', pose_stamped, mega_angle, make)
 
     def update_objects(self, board):
-        # update table position
-        self._obj.removeCollisionObject('table')
-        p = PoseStamped()
-        p.header.stamp = rospy.Time.now() - rospy.Duration(1.0)
-        p.header.frame_id = self.CHESS_BOARD_FRAME
-        p.pose.position.x = SQUARE_SIZE * 4
-        p.pose.position.y = SQUARE_SIZE * 4
-        p.pose.position.z = 0
-        p.pose.orientation.x = p.pose.orientation.y = p.pose.orientation.z = 0.0
-        p.pose.orientation.w = 1.0
-        pt = self.transform_pose(p)
-
-        thickness = pt.pose.position.z
-        pt.pose.position.x = 0.255 + .375
-        pt.pose.position.z = pt.pose.position.z/2.0
-        self._obj.addBox('table', 0.75, 1.5, thickness,
-                         pt.pose.position.x, pt.pose.position.y, pt.pose.position.z, wait=False)
-        self._obj.setColor('table', 223.0/256.0, 90.0/256.0, 12.0/256.0)
-
-        # update piece positions
+        # table and pieces, as board frame poses
+        pieces = list()
+        poses = [[SQUARE_SIZE * 4, SQUARE_SIZE * 4, 0, 0, 0, 0, 1]]
         for r in [1,2,3,4,5,6,7,8]:
             for c in 'abcdefgh':
                 p = board.getPiece(c,r)
                 if p != None:
-                    # insert this piece
                     height = board.getPieceHeight(p.type)
-                    radius = 0.015
-                    ps = PoseStamped()
-                    ps.header.stamp = rospy.Time.now() - rospy.Duration(1.0)
-                    ps.header.frame_id = self.CHESS_BOARD_FRAME
-                    ps.pose.position.x = p.pose.position.x
-                    ps.pose.position.y = p.pose.position.y
-                    ps.pose.position.z = height/2.0
-                    ps.pose.orientation.x = p.pose.orientation.y = p.pose.orientation.z = 0.0
-                    ps.pose.orientation.w = 1.0
-                    pt = self.transform_pose(ps)
-
-                    self._obj.addCylinder(board.getPieceId(p), height, radius, \
-                                          pt.pose.position.x, pt.pose.position.y, pt.pose.position.z, \
-                                          wait=False)
-                    if p.type < 0:
-                        self._obj.setColor(board.getPieceId(p), 0, 0, 0)
-                    else:
-                        self._obj.setColor(board.getPieceId(p), 0.8, 0.8, 0.8)
-
-        self._obj.waitForSync()
-        self._obj.sendColors()
-        rospy.loginfo('Done updating objects')
+                    pieces.append((p, height))
+                    poses.append([p.pose.position.x, p.pose.position.y, height/2.0, 0, 0, 0, 1])
+        positions = self.transform_poses(poses)
+        if positions is None:
+            # no board transform yet, ask tf one pose at a time
+            positions = list()
+            for pose in poses:
+                ps = PoseStamped()
+                ps.header.stamp = rospy.Time.now() - rospy.Duration(1.0)
+                ps.header.frame_id = self.CHESS_BOARD_FRAME
+                ps.pose.position.x, ps.pose.position.y, ps.pose.position.z = pose[0:3]
+                ps.pose.orientation.w = 1.0
+                pt = self.transform_pose(ps)
+                positions.append([pt.pose.position.x, pt.pose.position.y, pt.pose.position.z])
+        positions = np.asarray(positions)[:, 0:3].tolist()
+
+        # wanted scene: name -> (shape, dimensions, position, color)
+        objects = dict()
+        (x, y, thickness) = positions[0]
+        objects['table'] = (SolidPrimitive.BOX, (0.75, 1.5, thickness), (0.255 + .375, y, thickness/2.0),
+                            (223.0/256.0, 90.0/256.0, 12.0/256.0))
+        radius = 0.015
+        for ((p, height), position) in zip(pieces, positions[1:]):
+            if p.type < 0:
+                color = (0, 0, 0)
+            else:
+                color = (0.8, 0.8, 0.8)
+            objects[board.getPieceId(p)] = (SolidPrimitive.CYLINDER, (height, radius), tuple(position), color)
 
-    def move_piece(self, name, start_pose, end_pose):
+        changed, removed = self.scene.diff(objects)
+        if len(changed) == 0 and len(removed) == 0:
+            rospy.loginfo('Planning scene is up to date')
+            return
+        # send it all as one diff, which is applied by the time the call returns
+        scene = PlanningScene()
+        scene.is_diff = True
+        for name in changed:
+            (shape, dimensions, position, color) = objects[name]
+            o = CollisionObject()
+            o.header.frame_id = FIXED_FRAME
+            o.id = name
+            o.operation = CollisionObject.ADD
+            solid = SolidPrimitive()
+            solid.type = shape
+            solid.dimensions = list(dimensions)
+            o.primitives.append(solid)
+            pose = Pose()
+            pose.position.x, pose.position.y, pose.position.z = position
+            pose.orientation.w = 1.0
+            o.primitive_poses.append(pose)
+            scene.world.collision_objects.append(o)
+            c = ObjectColor()
+            c.id = name
+            c.color.r, c.color.g, c.color.b, c.color.a = color + (0.9,)
+            scene.object_colors.append(c)
+        for name in removed:
+            o = CollisionObject()
+            o.header.frame_id = FIXED_FRAME
+            o.id = name
+            o.operation = CollisionObject.REMOVE
+            scene.world.collision_objects.append(o)
+        try:
+            self._apply_scene(scene)
+        except (rospy.ServiceException, rospy.ROSException) as e:
+            rospy.logwarn('Unable to apply planning scene diff (%s), sending objects one by one' % e)
+            for name in removed:
+                self._obj.removeCollisionObject(name, wait=False)
+            for name in changed:
+                (shape, dimensions, position, color) = objects[name]
+                if shape == SolidPrimitive.BOX:
+                    self._obj.addBox(name, dimensions[0], dimensions[1], dimensions[2],
+                                     position[0], position[1], position[2], wait=False)
+                else:
+                    self._obj.addCylinder(name, dimensions[0], dimensions[1],
+                                          position[0], position[1], position[2], wait=False)
+                self._obj.setColor(name, color[0], color[1], color[2])
+            self._obj.waitForSync()
+            self._obj.sendColors()
+        self.scene.apply(objects, changed, removed)
+        rospy.loginfo('Done updating objects: %d changed, %d removed (%d poses transformed, %d left to tf)' %
+                      (len(changed), len(removed), self.batched_poses, self.tf_fallbacks))
+
+    def ranked_candidates(self, kind, pose_stamped, key, widened):
+        """ Grasps or places for a pose, most likely to work first. Grasps get their score as quality. """
+        if kind == 'grasp':
+            candidates = self.make_grasps(pose_stamped, widened)
+        else:
+            candidates = self.make_places(pose_stamped, widened)
+        candidates, scores = self.grasp_stats.order(key, candidates, prune = not widened)
+        if kind == 'grasp':
+            for (g, score) in zip(candidates, scores):
+                g.grasp_quality = score
+        return candidates
+
+    def move_piece(self, name, start_pose, end_pose, piece_type=0, start_square='', end_square='', following=None):
+        start = time.time()
+        if self.pick_and_place(name, start_pose, end_pose, piece_type, start_square, end_square, following):
+            self.timing['pick_place'].append(time.time() - start)
+            self.scene.forget(name)     # placed where the arm put it, resent from the board next time
+            return True
+        self.scene.clear()  # could be anywhere, or still in the gripper
+        return False
+
+    def pick_and_place(self, name, start_pose, end_pose, piece_type=0, start_square='', end_square='', following=None):
+        """
+        Move a piece. The pick of the following ArmSegment, if any, is
+        planned once this piece has been let go, while the arm retreats.
+        """
         rospy.loginfo('Moving %s' % name)
-        # pick it up
-        grasps = self.make_grasps(start_pose)
-        attempts = 0
+        if not self.pick(name, start_pose, piece_type, start_square):
+            return False
+        if following == None:
+            return self.place(name, end_pose, piece_type, end_square)
+        placing = MoveFuture()
+        def place():
+            try:
+                placing.setResult(self.place(name, end_pose, piece_type, end_square))
+            except Exception as e:
+                rospy.logerr('Place of %s failed: %s' % (name, e))
+                placing.setResult(False)
+        thread = Thread(target=place)
+        thread.daemon = True
+        thread.start()
+        ahead = None
+        # plan from a scene without this piece in the gripper, so once it has been let go
+        while not placing.done() and name in self._obj.getKnownAttachedObjects():
+            rospy.sleep(0.05)
+        if not placing.done():
+            ahead = self.plan_ahead(following)
+        placed = placing.result()
+        if ahead != None:
+            grasp = ahead.result(self.ahead_wait)
+            if not ahead.done():
+                self.speculation['late'] += 1   # not worth waiting for, the pick plans anyways
+            elif placed and grasp != None:
+                self.pre_grasps[following.name] = grasp
+            else:
+                self.speculation['discarded'] += 1  # things didn't go as planned
+        return placed
+
+    def plan_ahead(self, segment):
+        """
+        Start planning the pick of an ArmSegment in the background, returns
+        a MoveFuture for the grasp that worked (None if none did), or None
+        if there is no segment.
+        """
+        if segment == None:
+            return None
+        key = self.grasp_stats.key('grasp', segment.start_square, segment.piece_type)
+        candidates = self.ranked_candidates('grasp', segment.start_pose, key, False)
+        future = MoveFuture()
+        def plan():
+            try:
+                result = self._grasp.pickup(segment.name, candidates, plan_only=True)
+                if result.error_code.val == MoveItErrorCodes.SUCCESS:
+                    future.setResult(result.grasp.id)
+                    return
+            except Exception as e:
+                rospy.logwarn('Unable to plan ahead for %s: %s' % (segment.name, e))
+            future.setResult(None)
+        thread = Thread(target=plan)
+        thread.daemon = True
+        thread.start()
+        self.speculation['ahead'] += 1
+        return future
+
+    def pick(self, name, start_pose, piece_type=0, start_square=''):
+        key = self.grasp_stats.key('grasp', start_square, piece_type)
+        planned = self.pre_grasps.pop(name, None)
+        start = time.time()
         while True:
             # limit retries before we abort
-            if attempts > 10:
-                grasps = self.make_grasps(start_pose, True)  # regen grasps with wider angles
-            if attempts > 50:
+            elapsed = time.time() - start
+            if elapsed > self.retry_budget:
+                rospy.logerr('Giving up on picking %s after %.1fs' % (name, elapsed))
                 return False
+            # most likely first, wider angles (and those that never worked here) once it has taken a while
+            grasps = self.ranked_candidates('grasp', start_pose, key, elapsed > self.widen_after)
+            if planned != None:
+                # planned while the opponent was thinking, try that grasp on its own first
+                grasps = [g for g in self.make_grasps(start_pose, True) if g.id == planned] or grasps
+                planned = None
             # attempt grasp
             result = self._grasp.pickup(name, grasps)
             if result.error_code.val == MoveItErrorCodes.SUCCESS:
                 rospy.loginfo('Pick succeeded')
-                break
+                self.grasp_stats.record(key, grasps, result.grasp.id)
+                return True
             elif result.error_code.val == MoveItErrorCodes.PLANNING_FAILED:
                 rospy.logerr('Pick failed in the planning stage, try again...')
+                self.grasp_stats.record(key, grasps)
                 rospy.sleep(0.5)  # short sleep to try and let state settle a bit?
-                attempts += 1
                 continue
             elif result.error_code.val == MoveItErrorCodes.CONTROL_FAILED or \
                  result.error_code.val == MoveItErrorCodes.MOTION_PLAN_INVALIDATED_BY_ENVIRONMENT_CHANGE or \
@@ -782,36 +1915,38 @@ class ChessArmPlanner(Thread):
                 rospy.logerr('Pick failed during execution, attempting to cleanup.')
                 if name in self._obj.getKnownAttachedObjects():
                     rospy.loginfo('Pick managed to grab piece, retreat must have failed, continuing anyways')
-                    break
+                    return True
                 else:
                     rospy.loginfo('Pick did not grab piece, try again...')
-                    attempts += 1
                     continue
             else:
                 # unhandled error, abort
                 rospy.logerr('Pick failed with error code: %d.' % result.error_code.val)
                 return False
 
-        # put it down
+    def place(self, name, end_pose, piece_type=0, end_square=''):
         rospy.loginfo('Placing %s' % name)
-        places = self.make_places(end_pose)
-        attempts = 0
+        key = self.grasp_stats.key('place', end_square, piece_type)
+        start = time.time()
         while True:
             # limit retries before we abort
-            if attempts > 10:
-                places = self.make_places(end_pose, True)  # regen places with wider angles
-            if attempts > 50:
+            elapsed = time.time() - start
+            if elapsed > self.retry_budget:
                 # TODO: try to replace piece and replan?
+                rospy.logerr('Giving up on placing %s after %.1fs' % (name, elapsed))
                 return False
+            # most likely first, wider angles (and those that never worked here) once it has taken a while
+            places = self.ranked_candidates('place', end_pose, key, elapsed > self.widen_after)
             # attempt place
             result = self._grasp.place(name, places)
             if result.error_code.val == MoveItErrorCodes.SUCCESS:
                 rospy.loginfo('Place succeeded')
-                break
+                self.grasp_stats.record(key, places, result.place_location.id)
+                return True
             elif result.error_code.val == MoveItErrorCodes.PLANNING_FAILED:
                 rospy.logerr('Place failed in the planning stage, try again...')
+                self.grasp_stats.record(key, places)
                 rospy.sleep(0.5)  # short sleep to try and let state settle a bit?
-                attempts += 1
                 continue
             elif result.error_code.val == MoveItErrorCodes.CONTROL_FAILED or \
                  result.error_code.val == MoveItErrorCodes.MOTION_PLAN_INVALIDATED_BY_ENVIRONMENT_CHANGE or \
@@ -819,93 +1954,151 @@ class ChessArmPlanner(Thread):
                 rospy.logerr('Place failed during execution, attempting to cleanup.')
                 if name in self._obj.getKnownAttachedObjects():
                     rospy.loginfo('Place did not place object, approach must have failed, will retry...')
-                    attempts += 1
                     continue
                 else:
                     rospy.loginfo('Object no longer in gripper, must be placed, continuing...')
-                    break
+                    return True
             else:
                 # unhandled error
                 rospy.logerr('Place failed with error code: %d.' % result.error_code.val)
                 # TODO: try to replace piece and replan?
                 return False
-        return True
-
-    def execute(self, move, board):
-        """ Execute a move. """
 
-        self.update_objects(board)
-
-        # get info about move
+    def speculate(self, predicted, move, board):
+        """
+        Plan the picks for our move in the background, expecting the
+        opponent to play predicted on board. execute() uses them if the
+        board and our move turn out as expected.
+        """
+        self.speculator.submit(self.pre_plan, predicted, move, board, self.generation)
+
+    def pre_plan(self, predicted, move, board, generation):
+        expected = board.snapshot()
+        expected.applyMove(predicted)
+        grasps = dict()
+        start = time.time()
+        for segment in self.segments(move, expected):
+            if segment.square in (predicted[0:2], predicted[2:4]):
+                continue    # the opponent's move changes this, the scene doesn't show it yet
+            with self.busy:
+                if generation != self.generation:
+                    return  # too late
+                key = self.grasp_stats.key('grasp', segment.start_square, segment.piece_type)
+                candidates = self.ranked_candidates('grasp', segment.start_pose, key, False)
+                result = self._grasp.pickup(segment.name, candidates, plan_only=True)
+            if result.error_code.val == MoveItErrorCodes.SUCCESS:
+                grasps[segment.name] = result.grasp.id
+        self.speculation['planned'] += 1
+        self.pre_plans[(expected.zobrist, move)] = grasps
+        rospy.loginfo('Planned %d picks for %s after %s in %.1fs' % (len(grasps), move, predicted, time.time() - start))
+
+    def piece_pose(self, piece, board):
+        """ Pose to pick a piece up at, in FIXED_FRAME. """
+        pose = PoseStamped()
+        pose.header.stamp = rospy.Time.now() - rospy.Duration(1.0)
+        pose.header.frame_id = self.CHESS_BOARD_FRAME
+        pose.pose = piece.pose
+        pose.pose.position.z = board.getPieceHeight(piece.type)
+        return self.transform_pose(pose)
+
+    def segments(self, move, board, role='move'):
+        """ ArmSegments to make a move, in the order the arm carries them out. """
         (col_f, rank_f) = board.toPosition(move[0:2])
         (col_t, rank_t) = board.toPosition(move[2:])
         fr_piece = board.getPiece(col_f, rank_f)
         to_piece = board.getPiece(col_t, rank_t)
-
-        # get name of piece
-        fr_id = board.getPieceId(fr_piece)
-
-        # transform
-        fr = PoseStamped()
-        fr.header.stamp = rospy.Time.now() - rospy.Duration(1.0)
-        fr.header.frame_id = "chess_board"
-        fr.pose = fr_piece.pose
-        fr.pose.position.z = board.getPieceHeight(fr_piece.type)
-        fr = self.transform_pose(fr)
+        segments = list()
 
         # is this a capture?
+        (col_c, rank_c, square) = (col_t, rank_t, move[2:4])
+        if to_piece == None and abs(fr_piece.type) == ChessPiece.WHITE_PAWN and col_f != col_t:
+            # en passant, the pawn that was passed is beside us
+            (col_c, rank_c, square) = (col_t, rank_f, move[2] + move[1])
+            to_piece = board.getPiece(col_c, rank_c)
         if to_piece != None:
-            # get name of piece
-            to_id = board.getPieceId(to_piece)
-            print 'Capturing', to_id
-
-            to = PoseStamped()
-            to.header.stamp = rospy.Time.now() - rospy.Duration(1.0)
-            to.header.frame_id = "chess_board"
-            to.pose = to_piece.pose
-            to.pose.position.z = board.getPieceHeight(to_piece.type)
-            to = self.transform_pose(to)
-
-            # get name of piece
-            to_id = board.getPieceId(to_piece)
-
             off_board = PoseStamped()
             off_board.header.stamp = rospy.Time.now() - rospy.Duration(1.0)
-            off_board.header.frame_id = "chess_board"
+            off_board.header.frame_id = self.CHESS_BOARD_FRAME
             off_board.pose.position.x = OFF_BOARD_X
             off_board.pose.position.y = OFF_BOARD_Y
             off_board.pose.position.z = OFF_BOARD_Z
-            off_board = self.transform_pose(off_board)
-
-            if not self.move_piece(to_id, to, off_board):
-                rospy.logerr('Failed to move captured piece')
-                self.success = False
-                self.tuck()
-                return None
-
-            # remove from planning scene
-            self._obj.removeCollisionObject(to_id)
+            segments.append(ArmSegment('capture', board.getPieceId(to_piece), to_piece.type,
+                                       self.piece_pose(to_piece, board), self.transform_pose(off_board),
+                                       self.square_name(col_c, rank_c, board), 'off', square))
 
         to = PoseStamped()
         to.header.stamp = rospy.Time.now() - rospy.Duration(1.0)
-        to.header.frame_id = "chess_board"
+        to.header.frame_id = self.CHESS_BOARD_FRAME
         height = board.getPieceHeight(fr_piece.type)/2.0 + 0.0075  # object-centric use half height plus small margin
         to.pose = self.getPose(col_t, rank_t, board, height)
-        to = self.transform_pose(to)
-
-        if not self.move_piece(fr_id, fr, to):
-            rospy.logerr('Failed to move %s' % move[0:2])
-            self.success = False
-            self.tuck()
-            return None
+        segments.append(ArmSegment(role, board.getPieceId(fr_piece), fr_piece.type,
+                                   self.piece_pose(fr_piece, board), self.transform_pose(to),
+                                   self.square_name(col_f, rank_f, board), self.square_name(col_t, rank_t, board),
+                                   move[0:2]))
 
         if move in castling_extras:
-            if not self.execute(castling_extras[move],board):
-                rospy.logerr('Failed to carry out castling extra')
+            segments += self.segments(castling_extras[move], board, 'castle')
+        return segments
+
+    def execute(self, move, board):
+        """ Execute a move, using picks planned ahead for it if there are any. """
+        self.generation += 1
+        with self.busy:
+            self.pre_grasps = self.pre_plans.pop((board.zobrist, move), dict())
+            if len(self.pre_grasps) > 0:
+                self.speculation['used'] += 1
+                rospy.loginfo('Using picks planned ahead for %s' % move)
+            self.speculation['stale'] += len(self.pre_plans)
+            self.pre_plans = dict()
+            return self.execute_move(move, board)
+
+    def execute_move(self, move, board):
+        """
+        Execute a move. The pick of each piece after the first is planned
+        while the arm is still retreating from the one before it.
+        """
+
+        start = time.time()
+        self.update_objects(board)
+        self.timing['scene'].append(time.time() - start)
+
+        segments = self.segments(move, board)
+        to = None
+        for (i, segment) in enumerate(segments):
+            following = None
+            if i + 1 < len(segments):
+                following = segments[i+1]
+            if segment.role == 'capture':
+                print 'Capturing', segment.name
+
+            if not self.move_piece(segment.name, segment.start_pose, segment.end_pose, segment.piece_type,
+                                   segment.start_square, segment.end_square, following):
+                self.success = False
+                if segment.role == 'castle':
+                    rospy.logerr('Failed to carry out castling extra')
+                    break
+                if segment.role == 'capture':
+                    rospy.logerr('Failed to move captured piece')
+                else:
+                    rospy.logerr('Failed to move %s' % segment.square)
+                self.tuck()
+                return None
+
+            if segment.role == 'capture':
+                # remove from planning scene
+                self._obj.removeCollisionObject(segment.name)
+                self.scene.forget(segment.name)
+            elif segment.role == 'move':
+                to = segment.end_pose
 
         self.tuck()
         return to.pose
 
+    def square_name(self, col, rank, board):
+        """ Square as the robot sees it, the same whichever side we play. """
+        p = self.getPose(col, rank, board)
+        return '%d,%d' % (int(p.position.x / SQUARE_SIZE), int(p.position.y / SQUARE_SIZE))
+
     def getPose(self, col, rank, board, z=0):
         """ Find the reach required to get to a position """
         p = Pose()
@@ -920,10 +2113,12 @@ class ChessArmPlanner(Thread):
         return p
 
     def tuck(self):
+        start = time.time()
         if joints_tucked:
             self._move.moveToJointPosition(joint_names, joints_tucked)
         else:
             self._move.moveToJointPosition(joint_names, joints_ready)
+        self.timing['tuck'].append(time.time() - start)
 
     def untuck(self):
         if joints_untucked:
@@ -0,0 +1,738 @@
+#!/usr/bin/env python
+
+"""
+  Copyright (c) 2011-2013 Michael E. Ferguson. All right reserved.
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software Foundation,
+  Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+
+import multiprocessing
+import os
+import re
+import shelve
+import shlex
+import subprocess
+import threading
+import time
+
+from collections import OrderedDict
+from threading import Thread
+
+from chess_player.bitboard_utilities import moveFrom, moveTo, moveFlags, CASTLE, EN_PASSANT
+
+ENGINE_COMMAND = '/usr/games/gnuchess -x'
+
+class MoveFuture:
+    """
+    The answer to an engine request, which may not be known yet.
+    result() blocks until the engine has answered.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.move = None
+        self.finished = False
+        self.ponder_hit = False     # answer came from pondering on the right move
+        self.cache_hit = False      # answer came from the move cache
+        self.forced = False         # only legal move, nothing to think about
+        self.tablebase_hit = False  # answer came from the endgame tablebases
+        self.error = None           # why there is no answer, if the engine failed
+        self.start_time = time.time()
+        self.done_time = None
+        self.callbacks = list()
+
+    def done(self):
+        return self.finished
+
+    def result(self, timeout=None):
+        """ Wait for the engine's move, None if it was illegal (or the wait timed out). """
+        deadline = None
+        timer = None
+        if timeout != None:
+            deadline = time.time() + timeout
+            timer = threading.Timer(timeout, self.wake)
+            timer.daemon = True
+            timer.start()
+        with self.condition:
+            while not self.finished:
+                if deadline != None and time.time() >= deadline - 0.001:
+                    break
+                self.condition.wait()
+            move = self.move
+        if timer != None:
+            timer.cancel()
+        return move
+
+    def setResult(self, move):
+        with self.condition:
+            self.move = move
+            self.finished = True
+            self.done_time = time.time()
+            self.condition.notify_all()
+        for callback in self.callbacks:
+            callback(self)
+
+    def addDoneCallback(self, callback):
+        """ Call callback(future) once the answer is known. """
+        with self.condition:
+            if not self.finished:
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def latency(self):
+        if self.done_time == None:
+            return None
+        return self.done_time - self.start_time
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+
+class EngineWorker(Thread):
+    """ Runs engine jobs one after another, in order, in its own thread. """
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self.condition = threading.Condition()
+        self.jobs = list()
+        self.closed = False
+
+    def submit(self, job, *args):
+        with self.condition:
+            self.jobs.append((job, args))
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.jobs) == 0 and not self.closed:
+                    self.condition.wait()
+                if len(self.jobs) == 0:
+                    return
+                (job, args) = self.jobs.pop(0)
+            job(*args)
+
+class EngineError(Exception):
+    """ The engine died, or answered with an error. """
+    pass
+
+class EngineTimeout(EngineError):
+    """ The engine did not answer in time. """
+    pass
+
+class EngineEvent:
+    """ One line of engine output, sorted into a kind. """
+    MOVE = 'move'
+    ILLEGAL = 'illegal'
+    HINT = 'hint'
+    INFO = 'info'       # thinking output: ply, score, time, nodes, pv
+    RESULT = 'result'   # game over
+    ERROR = 'error'
+    TEXT = 'text'       # anything else
+    EOF = 'eof'         # engine went away
+
+    def __init__(self, kind, line, move=None):
+        self.kind = kind
+        self.line = line
+        self.move = move
+        self.time = time.time()
+        self.ply = None
+        self.score = None
+        self.nodes = None
+        self.pv = None
+
+    def __str__(self):
+        return "%s: %s" % (self.kind, self.line)
+
+MOVE_LINE = re.compile(r'(?:My move is\s*:?|^move)\s*([a-h][1-8][a-h][1-8][qrbnQRBN]?)')
+HINT_LINE = re.compile(r'^Hint:\s*([a-h][1-8][a-h][1-8][qrbnQRBN]?)')
+INFO_LINE = re.compile(r'^\s*(\d+)\s+(-?\d+)\s+(\d+)\s+(\d+)\s+(.*)$')
+RESULT_LINE = re.compile(r'^(1-0|0-1|1/2-1/2)')
+
+def parseEngineLine(line):
+    """ Turn a line of xboard style engine output into an EngineEvent. """
+    m = MOVE_LINE.search(line)
+    if m:
+        return EngineEvent(EngineEvent.MOVE, line, m.group(1).lower())
+    if line.startswith('Illegal move'):
+        return EngineEvent(EngineEvent.ILLEGAL, line)
+    m = HINT_LINE.match(line)
+    if m:
+        return EngineEvent(EngineEvent.HINT, line, m.group(1).lower())
+    m = INFO_LINE.match(line)
+    if m:
+        event = EngineEvent(EngineEvent.INFO, line)
+        event.ply = int(m.group(1))
+        event.score = int(m.group(2))
+        event.nodes = int(m.group(4))
+        event.pv = m.group(5).split()
+        return event
+    if RESULT_LINE.match(line):
+        return EngineEvent(EngineEvent.RESULT, line)
+    if line.startswith('Error'):
+        return EngineEvent(EngineEvent.ERROR, line)
+    return EngineEvent(EngineEvent.TEXT, line)
+
+class EngineProcess:
+    """
+    One running chess engine, spoken to with xboard style commands. A
+    reader thread turns the engine's output into EngineEvents as it
+    arrives, so waiting for an answer never blocks past its deadline.
+    """
+
+    def __init__(self, command=ENGINE_COMMAND, grace=2.0):
+        self.command = command
+        self.grace = grace      # time to answer a move now, after the deadline
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        # statistics, in seconds
+        self.requests = 0
+        self.timeouts = 0
+        self.total_first_byte = 0.0
+        self.max_first_byte = 0.0
+        self.total_move = 0.0
+        self.max_move = 0.0
+        self.start()
+
+    def start(self):
+        self.process = subprocess.Popen(shlex.split(self.command), stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        with self.condition:
+            self.events = list()
+            self.closed = False
+            self.send_time = None
+            self.first_byte = None
+        self.session = None     # game this engine last played, when pooled
+        self.forced = False     # in force mode, moves need a go to get a reply
+        self.think_time = None  # seconds per move we last asked for
+        reader = Thread(target=self.read, args=(self.process,))
+        reader.daemon = True
+        reader.start()
+
+    def restart(self):
+        """ Replace a hung or dead engine with a fresh one. """
+        self.kill()
+        self.start()
+
+    def read(self, process):
+        """ Reader thread: split output into lines, and those into events. """
+        fd = process.stdout.fileno()
+        partial = ''
+        while True:
+            try:
+                data = os.read(fd, 4096)
+            except OSError:
+                data = ''
+            if not isinstance(data, str):
+                data = data.decode('ascii', 'replace')
+            with self.condition:
+                if process is not self.process:
+                    return  # restarted, nobody is listening
+                if not data:
+                    self.events.append(EngineEvent(EngineEvent.EOF, ''))
+                    self.closed = True
+                    self.condition.notify_all()
+                    return
+                if self.first_byte == None and self.send_time != None:
+                    self.first_byte = time.time()
+                lines = (partial + data).split('\n')
+                partial = lines.pop()
+                for line in lines:
+                    line = line.strip()
+                    if line != '':
+                        self.events.append(parseEngineLine(line))
+                self.condition.notify_all()
+
+    def send(self, line):
+        with self.write_lock:
+            try:
+                self.process.stdin.write((line + '\n').encode('ascii'))
+                self.process.stdin.flush()
+            except (IOError, OSError, ValueError):
+                raise EngineError("engine is not running")
+
+    def request(self, line):
+        """ Send a line we expect an answer to, clearing old output first. """
+        with self.condition:
+            self.events = list()
+            self.send_time = time.time()
+            self.first_byte = None
+        self.send(line)
+
+    def nextEvent(self, deadline=None):
+        """ Wait for the next event, None once the deadline passes. """
+        timer = None
+        if deadline != None:
+            timer = threading.Timer(max(deadline - time.time(), 0.0), self.wake)
+            timer.daemon = True
+            timer.start()
+        with self.condition:
+            while len(self.events) == 0 and not self.closed:
+                if deadline != None and time.time() >= deadline - 0.001:
+                    break
+                self.condition.wait()
+            event = None
+            if len(self.events) > 0:
+                event = self.events.pop(0)
+            elif self.closed:
+                event = EngineEvent(EngineEvent.EOF, '')
+        if timer != None:
+            timer.cancel()
+        return event
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def newGame(self):
+        self.send('new')
+        self.forced = False
+
+    def force(self, moves):
+        """ Play moves on the engine's board, without it replying. """
+        self.send('force')
+        for move in moves:
+            self.send(move)
+        self.forced = True
+
+    def setBoard(self, fen):
+        """ Set up a position, without the engine starting to think. """
+        self.send('force')
+        self.send('setboard ' + fen)
+        self.forced = True
+
+    def setThinkTime(self, seconds):
+        """ Time per move, the engine only takes whole seconds. """
+        seconds = max(1, int(round(seconds)))
+        if seconds != self.think_time:
+            self.send('st %d' % seconds)
+            self.think_time = seconds
+
+    def think(self, move, timeout=None, info=None):
+        """
+        Send a move (or go) to the engine and wait for its reply, None if
+        the move was illegal. If the engine is still thinking at timeout
+        seconds it is told to move now; raises EngineTimeout if it still
+        does not answer, EngineError if it quits or complains. Thinking
+        output is passed to info(event), if given.
+        """
+        if self.forced:
+            if move != 'go':
+                self.send(move)
+            move = 'go'
+            self.forced = False
+        self.request(move)
+        self.requests += 1
+        deadline = None
+        if timeout != None:
+            deadline = self.send_time + timeout
+        hurried = False
+        while True:
+            event = self.nextEvent(deadline)
+            if event == None:
+                if hurried:
+                    self.timeouts += 1
+                    raise EngineTimeout("no answer to %s after %.1fs" % (move, time.time() - self.send_time))
+                self.moveNow()
+                hurried = True
+                deadline = time.time() + self.grace
+            elif event.kind == EngineEvent.MOVE:
+                self.recordLatency(event.time)
+                return event.move
+            elif event.kind == EngineEvent.ILLEGAL:
+                return None
+            elif event.kind == EngineEvent.INFO:
+                if info != None:
+                    info(event)
+            elif event.kind in (EngineEvent.ERROR, EngineEvent.RESULT, EngineEvent.EOF):
+                raise EngineError("engine answered %s to %s" % (event, move))
+
+    def recordLatency(self, done):
+        with self.condition:
+            first_byte = (self.first_byte or done) - self.send_time
+            move = done - self.send_time
+        self.total_first_byte += first_byte
+        self.max_first_byte = max(self.max_first_byte, first_byte)
+        self.total_move += move
+        self.max_move = max(self.max_move, move)
+
+    def replaceLast(self, move):
+        """ Take back the engine's last move and play another in its place. """
+        self.send('force')
+        self.send('undo')
+        self.send(move)
+        self.forced = True
+
+    def hint(self, timeout=2.0):
+        """ The move the engine expects from its opponent, None if it has no idea. """
+        self.request('hint')
+        deadline = time.time() + timeout
+        while True:
+            event = self.nextEvent(deadline)
+            if event == None or event.kind == EngineEvent.EOF:
+                return None
+            if event.kind == EngineEvent.HINT:
+                return event.move
+
+    def moveNow(self):
+        self.send('?')
+
+    def getStats(self):
+        """ Request counts and latency (send to first byte, send to move), in seconds. """
+        n = max(self.requests - self.timeouts, 1)
+        return { 'requests': self.requests,
+                 'timeouts': self.timeouts,
+                 'mean_first_byte': self.total_first_byte / n,
+                 'max_first_byte': self.max_first_byte,
+                 'mean_move': self.total_move / n,
+                 'max_move': self.max_move }
+
+    def kill(self):
+        try:
+            self.process.kill()
+            self.process.wait()
+        except OSError:
+            pass
+
+    def exit(self):
+        try:
+            self.send('exit')
+        except EngineError:
+            pass
+
+class EngineRequest:
+    """ A position waiting for an engine in the pool. """
+
+    def __init__(self, session, fen, timeout=None, think_time=None):
+        self.session = session
+        self.fen = fen
+        self.timeout = timeout
+        self.think_time = think_time
+        self.future = MoveFuture()
+        self.start_time = None  # when an engine picked it up
+
+class EnginePool:
+    """
+    A number of warm engine processes shared by many games. Each game
+    opens a session, and asks for moves by position. Sessions take turns
+    (round robin), so a busy game can't starve the others. An engine that
+    switches to another game is reset with new, and every request sets
+    up its position with setboard.
+    """
+
+    def __init__(self, size=None, command=ENGINE_COMMAND):
+        if size == None:
+            size = multiprocessing.cpu_count()
+        self.condition = threading.Condition()
+        self.queues = dict()    # session -> list of requests
+        self.order = list()     # sessions, in the order they get served
+        self.sessions = 0
+        self.closed = False
+        # statistics
+        self.requests = 0
+        self.completed = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+        self.processes = [EngineProcess(command) for i in range(size)]
+        self.workers = list()
+        for process in self.processes:
+            worker = Thread(target=self.serve, args=(process,))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def newSession(self):
+        with self.condition:
+            self.sessions += 1
+            self.queues[self.sessions] = list()
+            self.order.append(self.sessions)
+            return self.sessions
+
+    def closeSession(self, session):
+        with self.condition:
+            for request in self.queues.pop(session, list()):
+                request.future.setResult(None)
+            if session in self.order:
+                self.order.remove(session)
+
+    def think(self, session, fen, timeout=None, think_time=None):
+        """
+        Ask for the best move in a position, returns a MoveFuture. The
+        engine is asked to think for think_time seconds, and has to answer
+        within timeout seconds once it picks up the request.
+        """
+        request = EngineRequest(session, fen, timeout, think_time)
+        with self.condition:
+            if self.closed or session not in self.queues:
+                request.future.setResult(None)
+                return request.future
+            self.queues[session].append(request)
+            self.requests += 1
+            self.max_depth = max(self.max_depth, self.queueDepth())
+            self.condition.notify()
+        return request.future
+
+    def queueDepth(self):
+        """ Number of requests waiting for an engine. """
+        return sum([len(q) for q in self.queues.values()])
+
+    def nextRequest(self):
+        with self.condition:
+            while not self.closed:
+                for session in self.order:
+                    if len(self.queues[session]) > 0:
+                        # served sessions go to the back of the line
+                        self.order.remove(session)
+                        self.order.append(session)
+                        return self.queues[session].pop(0)
+                self.condition.wait()
+            return None
+
+    def serve(self, process):
+        while True:
+            request = self.nextRequest()
+            if request == None:
+                return
+            request.start_time = time.time()
+            try:
+                if process.session != request.session:
+                    process.newGame()
+                    process.session = request.session
+                process.setBoard(request.fen)
+                if request.think_time != None:
+                    process.setThinkTime(request.think_time)
+                move = process.think('go', request.timeout)
+            except EngineError as e:
+                request.future.error = str(e)
+                process.restart()
+                move = None
+            request.future.setResult(move)
+            with self.condition:
+                self.completed += 1
+                latency = request.future.latency()
+                self.total_wait += request.start_time - request.future.start_time
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+    def getStats(self):
+        """ Queue depth and request latency, in seconds. """
+        with self.condition:
+            n = max(self.completed, 1)
+            return { 'processes': len(self.processes),
+                     'sessions': len(self.order),
+                     'queued': self.queueDepth(),
+                     'max_queued': self.max_depth,
+                     'requests': self.requests,
+                     'completed': self.completed,
+                     'mean_wait': self.total_wait / n,
+                     'mean_latency': self.total_latency / n,
+                     'max_latency': self.max_latency,
+                     'timeouts': sum([p.timeouts for p in self.processes]),
+                     'mean_first_byte': sum([p.getStats()['mean_first_byte'] for p in self.processes]) / len(self.processes) }
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            for session in list(self.queues.keys()):
+                for request in self.queues[session]:
+                    request.future.setResult(None)
+                self.queues[session] = list()
+            self.condition.notify_all()
+        for process in self.processes:
+            process.exit()
+
+class MoveCache:
+    """
+    Best moves by position (a Position.fenKey). Recently used positions
+    are kept in memory, least recently used are dropped first, and every
+    position is kept in a shelve file so answers survive restarts.
+
+    Freshness vs strength: each answer is stored with the strength of the
+    engine that found it (for instance its thinking time). An answer is
+    only used when it is at least as strong as the request, and no older
+    than max_age seconds (None to keep answers forever). A stronger answer
+    replaces a weaker one.
+    """
+
+    def __init__(self, path=None, size=4096, max_age=None):
+        self.lock = threading.Lock()
+        self.size = size
+        self.max_age = max_age
+        self.memory = OrderedDict()     # key -> (move, strength, time)
+        self.disk = None
+        if path != None:
+            self.disk = shelve.open(path)
+        # statistics
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.rejected = 0   # found, but too weak or too old
+        self.stores = 0
+
+    def get(self, key, strength=0.0):
+        """ Returns the cached move for a position, or None. """
+        with self.lock:
+            entry = self.memory.pop(key, None)
+            from_disk = False
+            if entry == None and self.disk != None:
+                entry = self.disk.get(key)
+                from_disk = entry != None
+            if entry == None:
+                self.misses += 1
+                return None
+            self.remember(key, entry)
+            (move, entry_strength, stamp) = entry
+            if entry_strength < strength or (self.max_age != None and time.time() - stamp > self.max_age):
+                self.rejected += 1
+                self.misses += 1
+                return None
+            if from_disk:
+                self.disk_hits += 1
+            else:
+                self.hits += 1
+            return move
+
+    def put(self, key, move, strength=0.0):
+        entry = (move, strength, time.time())
+        with self.lock:
+            old = self.memory.get(key)
+            if old == None and self.disk != None:
+                old = self.disk.get(key)
+            if old != None and old[1] > strength and \
+                    (self.max_age == None or time.time() - old[2] <= self.max_age):
+                return  # keep the stronger answer
+            self.memory.pop(key, None)
+            self.remember(key, entry)
+            if self.disk != None:
+                self.disk[key] = entry
+            self.stores += 1
+
+    def remember(self, key, entry):
+        self.memory[key] = entry
+        while len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    def getStats(self):
+        with self.lock:
+            lookups = max(self.hits + self.disk_hits + self.misses, 1)
+            return { 'hits': self.hits,
+                     'disk_hits': self.disk_hits,
+                     'misses': self.misses,
+                     'rejected': self.rejected,
+                     'stores': self.stores,
+                     'hit_rate': float(self.hits + self.disk_hits) / lookups,
+                     'in_memory': len(self.memory) }
+
+    def sync(self):
+        with self.lock:
+            if self.disk != None:
+                self.disk.sync()
+
+    def close(self):
+        with self.lock:
+            if self.disk != None:
+                self.disk.close()
+                self.disk = None
+
+class TimeManager:
+    """
+    Gives the engine a thinking budget for each move, so that thinking
+    plus arm motion takes about turn_time seconds. How long the arm will
+    take is predicted from how long recent moves took to execute, so a
+    quick last move leaves more time to think. How much the engine
+    overshoots its budget is measured as well, and taken into account.
+    """
+
+    def __init__(self, turn_time=30.0, min_think=1.0, max_think=20.0, arm_guess=15.0, smoothing=0.5):
+        self.turn_time = turn_time
+        self.min_think = min_think
+        self.max_think = max_think
+        self.smoothing = smoothing  # weight of the newest measurement
+        self.arm_time = arm_guess   # expected arm time for the next move
+        self.overshoot = 1.0        # engine time / budget
+        self.arm_times = list()
+        self.engine_times = list()
+
+    def budget(self, reserve=0.0):
+        """ Seconds the engine should think about the next move, reserve is needed for other things. """
+        think = (self.turn_time - self.arm_time - reserve) / self.overshoot
+        return min(max(think, self.min_think), self.max_think)
+
+    def recordArm(self, seconds):
+        self.arm_times.append(seconds)
+        self.arm_time += self.smoothing * (seconds - self.arm_time)
+
+    def recordEngine(self, seconds, budget=None):
+        self.engine_times.append(seconds)
+        if budget != None and budget > 0:
+            self.overshoot += self.smoothing * (seconds / budget - self.overshoot)
+            self.overshoot = max(self.overshoot, 0.25)
+
+    def getStats(self):
+        def mean(values):
+            return sum(values) / max(len(values), 1)
+        return { 'turn_time': self.turn_time,
+                 'moves': len(self.engine_times),
+                 'mean_engine': mean(self.engine_times),
+                 'mean_arm': mean(self.arm_times),
+                 'max_arm': max(self.arm_times + [0.0]),
+                 'expected_arm': self.arm_time,
+                 'overshoot': self.overshoot }
+
+class MoveCostModel:
+    """
+    Estimates how long the arm takes to make a move. Each piece moved
+    costs a pick and place, each execute costs a planning scene update
+    and a tuck, and there is a small cost per square travelled. Captures
+    (en passant too) and castling move two pieces. Times start from rough
+    guesses and follow the planner's measurements once update() is called.
+    """
+
+    def __init__(self, pick_place=20.0, overhead=5.0, travel=0.5):
+        self.pick_place = pick_place    # seconds per piece moved
+        self.overhead = overhead        # seconds per execute
+        self.travel = travel            # seconds per square
+
+    def update(self, planner):
+        """ Take times from the last few moves of a ChessArmPlanner. """
+        def mean(values):
+            values = values[-20:]
+            return sum(values) / len(values)
+        timing = planner.timing
+        if len(timing['pick_place']) > 0:
+            self.pick_place = mean(timing['pick_place'])
+        if len(timing['scene']) > 0 and len(timing['tuck']) > 0:
+            self.overhead = mean(timing['scene']) + mean(timing['tuck'])
+
+    def estimate(self, position, move):
+        """ Seconds to make a (legal) move in a Position. """
+        fr, to = moveFrom(move), moveTo(move)
+        pieces = 1
+        if position.squares[to] >= 0 or moveFlags(move) & EN_PASSANT:
+            pieces = 2      # captured piece goes off the board first
+        if moveFlags(move) & CASTLE:
+            pieces = 2      # rook follows the king
+        distance = max(abs(fr % 8 - to % 8), abs(fr // 8 - to // 8))
+        return pieces * self.pick_place + self.overhead + distance * self.travel
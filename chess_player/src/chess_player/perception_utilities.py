@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+"""
+  Copyright (c) 2011-2013 Michael E. Ferguson. All right reserved.
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software Foundation,
+  Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+
+import threading
+import time
+import numpy as np
+
+from threading import Thread
+
+class BoardFusion:
+    """
+    Fuses the last few perception frames into per-square occupancy and
+    color probabilities. Older frames count less (exponential decay).
+    A fused board is ready once it has been the same for a few frames,
+    or every square is known with high enough confidence.
+    """
+
+    def __init__(self, size=6, decay=0.6, stable_frames=2, threshold=0.95, min_frames=2):
+        self.size = size
+        self.decay = decay
+        self.stable_frames = stable_frames
+        self.threshold = threshold
+        self.min_frames = min_frames
+
+        # ring buffer of frames
+        self.occupied = np.zeros((size, 64), dtype=np.float32)
+        self.white = np.zeros((size, 64), dtype=np.float32)
+        self.weights = np.zeros(size, dtype=np.float32)
+
+        # fused result
+        self.p_occupied = np.zeros(64, dtype=np.float32)
+        self.p_white = np.zeros(64, dtype=np.float32)
+        self.board_occupied = np.zeros(64, dtype=bool)
+        self.board_color = np.zeros(64, dtype=np.int8)
+        self.reset()
+
+    def reset(self):
+        """ Forget all frames, for instance once the board has been accepted. """
+        self.head = -1
+        self.count = 0
+        self.stable = 0
+        self.confidence = 0.0
+        self.weights.fill(0.0)
+
+    def add(self, occupied, color):
+        """
+        Add a frame: occupied is a 64 element boolean array, color is
+        +1/-1 for white/black pieces. Returns True if the fused board
+        is ready to be used.
+        """
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.occupied[self.head] = occupied
+        self.white[self.head] = occupied & (color > 0)
+
+        # weight of each slot falls off with its age
+        ages = (self.head - np.arange(self.size)) % self.size
+        self.weights[:] = self.decay ** ages
+        self.weights[ages >= self.count] = 0.0
+
+        w = self.weights
+        occ = np.dot(w, self.occupied)
+        self.p_occupied[:] = occ / w.sum()
+        self.p_white[:] = np.dot(w, self.white) / np.maximum(occ, 1e-6)
+
+        occupied = self.p_occupied > 0.5
+        color = np.where(occupied, np.where(self.p_white >= 0.5, 1, -1), 0)
+        if np.array_equal(occupied, self.board_occupied) and np.array_equal(color, self.board_color):
+            self.stable += 1
+        else:
+            self.stable = 1
+        self.board_occupied[:] = occupied
+        self.board_color[:] = color
+
+        # confidence of the least certain square
+        certainty = np.maximum(self.p_occupied, 1.0 - self.p_occupied)
+        certainty = np.where(occupied, certainty * np.maximum(self.p_white, 1.0 - self.p_white), certainty)
+        self.confidence = float(certainty.min())
+        return self.ready()
+
+    def ready(self):
+        if self.count < self.min_frames:
+            return False
+        return self.stable >= self.stable_frames or self.confidence >= self.threshold
+
+class MoveDetector:
+    """
+    Watches the stream of boards during the opponent's turn and decides
+    when they are done moving: something disturbs the board (a hand adds
+    or hides pieces, squares change), then the board settles on a state
+    that differs from where it started.
+    """
+    IDLE = 0        # board looks like it did at the start
+    MOVING = 1      # something is going on
+    DONE = 2        # board settled after a real change
+
+    def __init__(self, settle_frames=3, spike=2):
+        self.settle_frames = settle_frames
+        self.spike = spike      # change in piece count that counts as a disturbance
+        self.condition = threading.Condition()
+        self.active = False
+        self.cancelled = False
+        self.start()
+        self.active = False     # until start() is called
+
+    def start(self):
+        """ Begin watching, the next frame is the starting board. """
+        with self.condition:
+            self.baseline = None
+            self.baseline_count = 0
+            self.last = None
+            self.still = 0
+            self.state = self.IDLE
+            self.start_time = time.time()
+            self.done_time = None
+            self.active = True
+
+    def add(self, occupied, count):
+        """ Add a frame: 64 element occupancy and number of pieces detected. """
+        if not self.active:
+            return
+        if self.baseline is None:
+            self.baseline = occupied.copy()
+            self.baseline_count = count
+            self.last = occupied.copy()
+            return
+        changed = not np.array_equal(occupied, self.last)
+        # more pieces than squares (or off the board) means something is in the way
+        clutter = abs(count - np.count_nonzero(occupied)) >= self.spike
+        self.last[:] = occupied
+        if self.state == self.IDLE:
+            if changed or clutter or abs(count - self.baseline_count) >= self.spike:
+                self.state = self.MOVING
+                self.still = 0
+            return
+        # moving, wait for the board to stop changing
+        if changed or clutter:
+            self.still = 0
+            return
+        self.still += 1
+        if self.still < self.settle_frames:
+            return
+        if np.array_equal(occupied, self.baseline):
+            # hand came and went, nothing moved
+            self.state = self.IDLE
+            return
+        with self.condition:
+            self.state = self.DONE
+            self.done_time = time.time()
+            self.active = False
+            self.condition.notify_all()
+
+    def waitForMove(self, timeout=None):
+        """
+        Block until the opponent is done moving, the wait is cancelled, or
+        timeout seconds pass. Returns True if a finished move was seen.
+        """
+        deadline = None
+        timer = None
+        if timeout != None:
+            deadline = time.time() + timeout
+            timer = threading.Timer(timeout, self.wake)
+            timer.daemon = True
+            timer.start()
+        with self.condition:
+            while self.state != self.DONE and not self.cancelled:
+                if deadline != None and time.time() >= deadline - 0.001:
+                    break
+                self.condition.wait()
+            self.active = False
+            result = self.state == self.DONE
+        if timer != None:
+            timer.cancel()
+        return result
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+class Mailbox:
+    """
+    A single slot for the newest message. Putting a message replaces any
+    message that has not been taken yet, so a slow reader only ever sees
+    the latest one. Counts how many messages were received, dropped in
+    favor of a newer one (coalesced) and processed.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.message = None
+        self.closed = False
+        self.received = 0
+        self.coalesced = 0
+        self.processed = 0
+
+    def put(self, message):
+        with self.condition:
+            if self.message != None:
+                self.coalesced += 1
+            self.message = message
+            self.received += 1
+            self.condition.notify()
+
+    def get(self):
+        """ Wait for and take the newest message, None once closed. """
+        with self.condition:
+            while self.message == None and not self.closed:
+                self.condition.wait()
+            message = self.message
+            self.message = None
+            return message
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class MailboxWorker(Thread):
+    """ Takes messages from a Mailbox and hands them to a function, in its own thread. """
+
+    def __init__(self, mailbox, handler):
+        Thread.__init__(self)
+        self.daemon = True
+        self.mailbox = mailbox
+        self.handler = handler
+
+    def run(self):
+        while True:
+            message = self.mailbox.get()
+            if message == None:
+                return
+            self.handler(message)
+            self.mailbox.processed += 1
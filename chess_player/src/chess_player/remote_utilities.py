@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+"""
+  Copyright (c) 2011-2013 Michael E. Ferguson. All right reserved.
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software Foundation,
+  Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+
+import socket
+import threading
+import time
+
+from threading import Thread
+
+from chess_player.engine_utilities import MoveFuture, EngineError
+
+ENGINE_PORT = 5125
+
+def formatTime(seconds):
+    if seconds == None:
+        return '-'
+    return '%.3f' % seconds
+
+def parseTime(text):
+    if text == '-':
+        return None
+    return float(text)
+
+class EngineServer:
+    """
+    Serves an EnginePool over TCP, so moves can be searched on another
+    machine than the robot's. Requests and replies are a line of text:
+
+        session <id>                                -> session <id> <session>
+        think <id> <session> <think> <timeout> <fen> -> move <id> <move>
+                                                       (or error <id> <why>)
+        close <session>
+
+    Times are in seconds, '-' for none, and move is 'none' if the engine
+    had no move. Each request is answered as soon as its move is found,
+    so a client may have many requests outstanding on one connection.
+    Sessions are closed when their connection is.
+    """
+
+    def __init__(self, pool, host='', port=ENGINE_PORT):
+        self.pool = pool
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(5)
+        self.port = self.socket.getsockname()[1]    # if port was 0
+        self.closed = False
+        self.open = list()      # connections being served
+        # statistics
+        self.connections = 0
+        self.requests = 0
+
+    def start(self):
+        """ Accept connections in the background. """
+        thread = Thread(target=self.serveForever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def serveForever(self):
+        while not self.closed:
+            try:
+                connection, address = self.socket.accept()
+            except socket.error:
+                return  # closed
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections += 1
+            self.open.append(connection)
+            thread = Thread(target=self.handle, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, connection):
+        lock = threading.Lock()
+        sessions = list()
+        def reply(line):
+            with lock:
+                try:
+                    connection.sendall((line + '\n').encode())
+                except socket.error:
+                    pass    # client is gone, nobody to tell
+        def answer(future, request_id):
+            if future.error != None:
+                reply('error %s %s' % (request_id, future.error))
+            else:
+                reply('move %s %s' % (request_id, future.move or 'none'))
+        reader = connection.makefile('r')
+        try:
+            while True:
+                line = reader.readline()
+                if line == '':
+                    break
+                words = line.split(None, 5)
+                if len(words) == 0:
+                    continue
+                self.requests += 1
+                if words[0] == 'session' and len(words) == 2:
+                    session = self.pool.newSession()
+                    sessions.append(session)
+                    reply('session %s %d' % (words[1], session))
+                elif words[0] == 'think' and len(words) == 6:
+                    session = int(words[2])
+                    if session not in sessions:
+                        reply('error %s unknown session %d' % (words[1], session))
+                        continue
+                    future = self.pool.think(session, words[5].strip(), parseTime(words[4]), parseTime(words[3]))
+                    future.addDoneCallback(lambda f, request_id=words[1]: answer(f, request_id))
+                elif words[0] == 'close' and len(words) == 2:
+                    session = int(words[1])
+                    if session in sessions:
+                        sessions.remove(session)
+                        self.pool.closeSession(session)
+                elif len(words) > 1:
+                    reply('error %s bad request' % words[1])
+        except (socket.error, ValueError):
+            pass
+        finally:
+            for session in sessions:
+                self.pool.closeSession(session)
+            if connection in self.open:
+                self.open.remove(connection)
+            connection.close()
+
+    def getStats(self):
+        return { 'connections': self.connections,
+                 'requests': self.requests }
+
+    def close(self):
+        """ Stop serving, and hang up on all clients. """
+        self.closed = True
+        for connection in [self.socket] + list(self.open):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.socket.close()
+
+class RemoteEnginePool:
+    """
+    Client for an EngineServer, used in place of an EnginePool. Requests
+    are pipelined: think() sends its request and returns a MoveFuture
+    right away, a reader thread matches replies to requests. A request
+    not answered within its timeout (reply_timeout if it has none) plus
+    grace seconds fails with an error, as do all outstanding requests if
+    the connection drops. Raises socket.error if the server can't be
+    reached.
+    """
+
+    def __init__(self, host, port=ENGINE_PORT, reply_timeout=60.0, grace=2.0, connect_timeout=2.0):
+        self.reply_timeout = reply_timeout
+        self.grace = grace
+        self.connect_timeout = connect_timeout
+        self.socket = socket.create_connection((host, port), connect_timeout)
+        self.socket.settimeout(None)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.write_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.pending = dict()   # request id -> MoveFuture
+        self.next_id = 0
+        self.closed = False
+        # statistics
+        self.requests = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.max_pending = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+        self.reader = Thread(target=self.read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def request(self, line, limit=None):
+        """ Send a request, returns a MoveFuture for its reply. """
+        future = MoveFuture()
+        with self.lock:
+            if self.closed:
+                future.error = 'not connected to remote engine'
+                future.setResult(None)
+                return future
+            self.next_id += 1
+            request_id = self.next_id
+            self.pending[request_id] = future
+            self.requests += 1
+            self.max_pending = max(self.max_pending, len(self.pending))
+        if limit != None:
+            timer = threading.Timer(limit, self.expire, args=(request_id, limit))
+            timer.daemon = True
+            timer.start()
+            future.addDoneCallback(lambda f: timer.cancel())
+        try:
+            with self.write_lock:
+                self.socket.sendall(('%s\n' % line.replace('#', str(request_id))).encode())
+        except socket.error as e:
+            self.fail('lost connection to remote engine (%s)' % e)
+        return future
+
+    def finish(self, request_id, move=None, error=None):
+        with self.lock:
+            future = self.pending.pop(request_id, None)
+            if future == None:
+                return  # already timed out
+            if error != None:
+                self.errors += 1
+            else:
+                self.completed += 1
+                latency = time.time() - future.start_time
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+        future.error = error
+        future.setResult(move)
+
+    def expire(self, request_id, limit):
+        with self.lock:
+            if request_id not in self.pending:
+                return
+            self.timeouts += 1
+        self.finish(request_id, error='no answer from remote engine in %.1fs' % limit)
+
+    def fail(self, why):
+        """ Connection is gone, fail everything outstanding. """
+        with self.lock:
+            self.closed = True
+            pending = list(self.pending.keys())
+        for request_id in pending:
+            self.finish(request_id, error=why)
+
+    def read(self):
+        reader = self.socket.makefile('r')
+        try:
+            while True:
+                line = reader.readline()
+                if line == '':
+                    break
+                words = line.split(None, 2)
+                if len(words) < 3:
+                    continue
+                request_id = int(words[1])
+                if words[0] == 'error':
+                    self.finish(request_id, error='remote engine: ' + words[2].strip())
+                elif words[2].strip() == 'none':
+                    self.finish(request_id)
+                else:
+                    self.finish(request_id, words[2].strip())
+        except (socket.error, ValueError):
+            pass
+        self.fail('lost connection to remote engine')
+
+    def newSession(self):
+        future = self.request('session #', self.connect_timeout)
+        session = future.result()
+        if future.error != None:
+            raise EngineError(future.error)
+        return int(session)
+
+    def closeSession(self, session):
+        try:
+            with self.write_lock:
+                self.socket.sendall(('close %d\n' % session).encode())
+        except socket.error:
+            pass
+
+    def think(self, session, fen, timeout=None, think_time=None):
+        """
+        Ask for the best move in a position, returns a MoveFuture, same
+        as EnginePool.think().
+        """
+        limit = self.reply_timeout
+        if timeout != None:
+            limit = timeout
+        return self.request('think # %d %s %s %s' % (session, formatTime(think_time), formatTime(timeout), fen),
+                            limit + self.grace)
+
+    def getStats(self):
+        """ Requests outstanding and latency, in seconds. """
+        with self.lock:
+            return { 'requests': self.requests,
+                     'completed': self.completed,
+                     'pending': len(self.pending),
+                     'max_pending': self.max_pending,
+                     'timeouts': self.timeouts,
+                     'errors': self.errors,
+                     'mean_latency': self.total_latency / max(self.completed, 1),
+                     'max_latency': self.max_latency }
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+
+"""
+  Copyright (c) 2011-2013 Michael E. Ferguson. All right reserved.
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software Foundation,
+  Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+
+import time
+
+from chess_player.bitboard_utilities import Position, moveToString, WHITE, BLACK, QUEEN, KING, EN_PASSANT
+
+MATE = 100000
+MATE_BOUND = MATE - 1000    # scores beyond this are mates
+INFINITY = 1000000
+
+# table entry flags
+EXACT = 0
+LOWER = 1   # score is at least this
+UPPER = 2   # score is at most this
+
+PIECE_VALUES = [100, 320, 330, 500, 900, 0]
+
+# piece square tables, from white's side with a1 first
+PAWN_TABLE = [  0,  0,  0,  0,  0,  0,  0,  0,
+                5, 10, 10,-20,-20, 10, 10,  5,
+                5, -5,-10,  0,  0,-10, -5,  5,
+                0,  0,  0, 20, 20,  0,  0,  0,
+                5,  5, 10, 25, 25, 10,  5,  5,
+               10, 10, 20, 30, 30, 20, 10, 10,
+               50, 50, 50, 50, 50, 50, 50, 50,
+                0,  0,  0,  0,  0,  0,  0,  0 ]
+KNIGHT_TABLE = [-50,-40,-30,-30,-30,-30,-40,-50,
+                -40,-20,  0,  5,  5,  0,-20,-40,
+                -30,  5, 10, 15, 15, 10,  5,-30,
+                -30,  0, 15, 20, 20, 15,  0,-30,
+                -30,  5, 15, 20, 20, 15,  5,-30,
+                -30,  0, 10, 15, 15, 10,  0,-30,
+                -40,-20,  0,  0,  0,  0,-20,-40,
+                -50,-40,-30,-30,-30,-30,-40,-50 ]
+BISHOP_TABLE = [-20,-10,-10,-10,-10,-10,-10,-20,
+                -10,  5,  0,  0,  0,  0,  5,-10,
+                -10, 10, 10, 10, 10, 10, 10,-10,
+                -10,  0, 10, 10, 10, 10,  0,-10,
+                -10,  5,  5, 10, 10,  5,  5,-10,
+                -10,  0,  5, 10, 10,  5,  0,-10,
+                -10,  0,  0,  0,  0,  0,  0,-10,
+                -20,-10,-10,-10,-10,-10,-10,-20 ]
+ROOK_TABLE = [  0,  0,  0,  5,  5,  0,  0,  0,
+               -5,  0,  0,  0,  0,  0,  0, -5,
+               -5,  0,  0,  0,  0,  0,  0, -5,
+               -5,  0,  0,  0,  0,  0,  0, -5,
+               -5,  0,  0,  0,  0,  0,  0, -5,
+               -5,  0,  0,  0,  0,  0,  0, -5,
+                5, 10, 10, 10, 10, 10, 10,  5,
+                0,  0,  0,  0,  0,  0,  0,  0 ]
+QUEEN_TABLE = [-20,-10,-10, -5, -5,-10,-10,-20,
+               -10,  0,  5,  0,  0,  0,  0,-10,
+               -10,  5,  5,  5,  5,  5,  0,-10,
+                 0,  0,  5,  5,  5,  5,  0, -5,
+                -5,  0,  5,  5,  5,  5,  0, -5,
+               -10,  0,  5,  5,  5,  5,  0,-10,
+               -10,  0,  0,  0,  0,  0,  0,-10,
+               -20,-10,-10, -5, -5,-10,-10,-20 ]
+KING_TABLE = [ 20, 30, 10,  0,  0, 10, 30, 20,
+               20, 20,  0,  0,  0,  0, 20, 20,
+              -10,-20,-20,-20,-20,-20,-20,-10,
+              -20,-30,-30,-40,-40,-30,-30,-20,
+              -30,-40,-40,-50,-50,-40,-40,-30,
+              -30,-40,-40,-50,-50,-40,-40,-30,
+              -30,-40,-40,-50,-50,-40,-40,-30,
+              -30,-40,-40,-50,-50,-40,-40,-30 ]
+
+def _scores():
+    """ Score of each piece (color*6 + kind) on each square, positive for white. """
+    tables = [PAWN_TABLE, KNIGHT_TABLE, BISHOP_TABLE, ROOK_TABLE, QUEEN_TABLE, KING_TABLE]
+    scores = list()
+    for kind in range(6):
+        scores.append([PIECE_VALUES[kind] + tables[kind][sq] for sq in range(64)])
+    for kind in range(6):
+        scores.append([-(PIECE_VALUES[kind] + tables[kind][sq ^ 56]) for sq in range(64)])
+    return scores
+
+SQUARE_SCORES = _scores()
+
+# distance of each square from the centre, to drive a lone king to the edge
+CENTRE_DISTANCE = [max(3 - sq % 8, sq % 8 - 4) + max(3 - sq // 8, sq // 8 - 4) for sq in range(64)]
+
+def toTable(score, ply):
+    """ Mate scores are stored as distance from the node, not from the root. """
+    if score >= MATE_BOUND:
+        return score + ply
+    if score <= -MATE_BOUND:
+        return score - ply
+    return score
+
+def fromTable(score, ply):
+    if score >= MATE_BOUND:
+        return score - ply
+    if score <= -MATE_BOUND:
+        return score + ply
+    return score
+
+class SearchTimeout(Exception):
+    pass
+
+class SearchEngine:
+    """
+    A small alpha-beta searcher that runs in process: iterative deepening
+    with a transposition table, quiescence search on captures, draws by
+    repetition and the fifty move rule, and moves
+    ordered by table move, captures (most valuable victim first), killers
+    and history. Search stops when the time budget (seconds) runs out,
+    the best move of the last finished depth is played.
+    """
+
+    def __init__(self, budget=1.0, max_depth=32, table_size=500000):
+        self.budget = budget
+        self.max_depth = max_depth
+        self.table_size = table_size
+        self.table = dict()     # key -> (depth, score, flag, move)
+        self.history = dict()   # move -> score, for ordering quiet moves
+        self.killers = list()
+        # results of the last search
+        self.nodes = 0
+        self.depth = 0
+        self.score = 0
+        self.pv = list()
+        self.elapsed = 0.0
+
+    def nextMove(self, move="go", board=None):
+        """
+        Same interface as GnuChessEngine: works from the board (with the
+        opponent's move already made), returns the move for board.side.
+        """
+        position = Position.fromBoard(board, board.side)
+        return self.bestMove(position)
+
+    def bestMove(self, position, budget=None):
+        """ Best move as a string, None if there are no legal moves. """
+        move = self.search(position, budget)
+        if move == None:
+            return None
+        return moveToString(move)
+
+    def search(self, position, budget=None):
+        """ Iterative deepening search, returns the best move found. """
+        if budget == None:
+            budget = self.budget
+        start = time.time()
+        self.deadline = start + budget
+        self.nodes = 0
+        self.depth = 0
+        self.score = 0
+        self.pv = list()
+        self.killers = [[None, None] for i in range(self.max_depth + 1)]
+        if len(self.table) > self.table_size:
+            self.table = dict()
+        for m in list(self.history.keys()):
+            self.history[m] //= 8
+
+        moves = position.legalMoves()
+        if len(moves) == 0:
+            return None
+        best = moves[0]
+        if len(moves) > 1:
+            # the root position is pushed and popped, search a copy
+            position = position.copy()
+            for depth in range(1, self.max_depth + 1):
+                try:
+                    score = self.alphaBeta(position, depth, -INFINITY, INFINITY, 0)
+                except SearchTimeout:
+                    break
+                entry = self.table.get(position.key())
+                if entry != None and entry[3] != None:
+                    best = entry[3]
+                self.depth = depth
+                self.score = score
+                if abs(score) >= MATE - self.max_depth:
+                    break   # found a mate, no need to look further
+                if time.time() - start > budget / 2:
+                    break   # next depth would not finish anyway
+            self.pv = self.principalVariation(position)
+        self.elapsed = time.time() - start
+        return best
+
+    def rankMoves(self, position, count=4, budget=None, include=None):
+        """
+        Score the best count moves (multi-PV), returns (move, score)
+        pairs as strings and centipawns for the side to move, best first.
+        The include move (a string) is always scored, even if it is not
+        among the best.
+        """
+        if budget == None:
+            budget = self.budget
+        start = time.time()
+        self.deadline = start + budget
+        self.nodes = 0
+        self.depth = 0
+        self.killers = [[None, None] for i in range(self.max_depth + 1)]
+        position = position.copy()
+        moves = position.legalMoves()
+        if include != None:
+            include = position.parseMove(include)
+        ranked = list()
+        for depth in range(1, self.max_depth + 1):
+            previous = dict(ranked)
+            order = sorted(moves, key=lambda m: -previous.get(m, -INFINITY))
+            results = dict()
+            try:
+                for m in order:
+                    # only need to know if a move makes it into the top count
+                    alpha = -INFINITY
+                    if m != include and len(results) >= count:
+                        alpha = sorted(results.values(), reverse=True)[count-1]
+                    position.push(m)
+                    try:
+                        score = -self.alphaBeta(position, depth - 1, -INFINITY, -alpha, 1)
+                    finally:
+                        position.pop()
+                    if score > alpha or m == include:
+                        results[m] = score
+            except SearchTimeout:
+                break
+            ranked = sorted(results.items(), key=lambda x: -x[1])
+            self.depth = depth
+            if time.time() - start > budget / 2:
+                break
+        self.elapsed = time.time() - start
+        best = [(m, score) for (m, score) in ranked[0:count]]
+        best += [(m, score) for (m, score) in ranked[count:] if m == include]
+        return [(moveToString(m), score) for (m, score) in best]
+
+    def principalVariation(self, position):
+        """ Follow table moves from the position. """
+        pv = list()
+        pushed = 0
+        while len(pv) < self.depth:
+            entry = self.table.get(position.key())
+            if entry == None or entry[3] == None or entry[3] not in position.legalMoves():
+                break
+            pv.append(moveToString(entry[3]))
+            position.push(entry[3])
+            pushed += 1
+        for i in range(pushed):
+            position.pop()
+        return pv
+
+    def evaluate(self, position):
+        """ Material and piece squares, from the side to move. """
+        score = 0
+        for (sq, p) in enumerate(position.squares):
+            if p >= 0:
+                score += SQUARE_SCORES[p][sq]
+        # against a lone king, push it to the edge and bring ours closer, or we never mate
+        for (strong, weak, sign) in [(WHITE, BLACK, 1), (BLACK, WHITE, -1)]:
+            if position.occ[weak] == position.bb[weak*6 + KING] and position.occ[strong] != position.bb[strong*6 + KING]:
+                k, w = position.kingSquare(strong), position.kingSquare(weak)
+                distance = abs(k % 8 - w % 8) + abs(k // 8 - w // 8)
+                # the king tables are for the middlegame, they would keep both kings home
+                score -= SQUARE_SCORES[strong*6 + KING][k] + SQUARE_SCORES[weak*6 + KING][w]
+                score += sign * (10 * CENTRE_DISTANCE[w] + 4 * (14 - distance))
+        if position.turn == BLACK:
+            return -score
+        return score
+
+    def tick(self):
+        self.nodes += 1
+        if self.nodes & 1023 == 0 and time.time() > self.deadline:
+            raise SearchTimeout()
+
+    def ordered(self, position, moves, best, ply):
+        """ Sort moves: table move, captures, killers, then history. """
+        squares = position.squares
+        killers = self.killers[ply]
+        keyed = list()
+        for m in moves:
+            if m == best:
+                key = 1000000
+            else:
+                victim = squares[(m >> 6) & 63]
+                if victim >= 0:
+                    key = 100000 + 10 * PIECE_VALUES[victim % 6] - PIECE_VALUES[squares[m & 63] % 6] // 10
+                elif (m >> 12) & 7 or (m >> 16) & EN_PASSANT:
+                    key = 100000 + PIECE_VALUES[(m >> 12) & 7]
+                elif m == killers[0] or m == killers[1]:
+                    key = 90000
+                else:
+                    key = self.history.get(m, 0)
+            keyed.append((key, m))
+        keyed.sort(reverse=True)
+        return [m for (key, m) in keyed]
+
+    def alphaBeta(self, position, depth, alpha, beta, ply):
+        self.tick()
+        if ply > 0 and (position.halfmove >= 100 or position.isRepetition()):
+            return 0
+        key = position.key()
+        entry = self.table.get(key)
+        best = None
+        if entry != None:
+            best = entry[3]
+            if entry[0] >= depth and ply > 0:
+                (score, flag) = (fromTable(entry[1], ply), entry[2])
+                if flag == EXACT or (flag == LOWER and score >= beta) or (flag == UPPER and score <= alpha):
+                    return score
+        if depth <= 0:
+            return self.quiesce(position, alpha, beta, ply)
+
+        us = position.turn
+        original_alpha = alpha
+        best_score = -INFINITY
+        legal = 0
+        for m in self.ordered(position, position.pseudoMoves(), best, min(ply, self.max_depth)):
+            quiet = position.squares[(m >> 6) & 63] < 0 and not (m >> 12) & 7 and not (m >> 16) & EN_PASSANT
+            position.push(m)
+            if position.attacked(position.kingSquare(us), us ^ 1):
+                position.pop()
+                continue
+            legal += 1
+            try:
+                score = -self.alphaBeta(position, depth - 1, -beta, -alpha, ply + 1)
+            finally:
+                position.pop()
+            if score > best_score:
+                best_score = score
+                best = m
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                if quiet:
+                    killers = self.killers[min(ply, self.max_depth)]
+                    if killers[0] != m:
+                        killers[1] = killers[0]
+                        killers[0] = m
+                    self.history[m] = self.history.get(m, 0) + depth * depth
+                break
+        if legal == 0:
+            if position.inCheck():
+                return -MATE + ply
+            return 0
+
+        flag = EXACT
+        if best_score <= original_alpha:
+            flag = UPPER
+        elif best_score >= beta:
+            flag = LOWER
+        self.table[key] = (depth, toTable(best_score, ply), flag, best)
+        return best_score
+
+    def quiesce(self, position, alpha, beta, ply):
+        """ Only look at captures, so we don't stop in the middle of a trade. """
+        self.tick()
+        stand = self.evaluate(position)
+        if stand >= beta:
+            return stand
+        if stand > alpha:
+            alpha = stand
+        us = position.turn
+        squares = position.squares
+        captures = [m for m in position.pseudoMoves()
+                    if squares[(m >> 6) & 63] >= 0 or (m >> 12) & 7 == QUEEN]
+        for m in self.ordered(position, captures, None, min(ply, self.max_depth)):
+            position.push(m)
+            if position.attacked(position.kingSquare(us), us ^ 1):
+                position.pop()
+                continue
+            try:
+                score = -self.quiesce(position, -beta, -alpha, ply + 1)
+            finally:
+                position.pop()
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+        return alpha
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""
+  Copyright (c) 2011-2013 Michael E. Ferguson. All right reserved.
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software Foundation,
+  Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+"""
+
+import os
+import re
+import threading
+import time
+
+from collections import OrderedDict
+
+# python-chess reads the syzygy files, without it there are no tablebases
+try:
+    import chess
+    import chess.syzygy
+except ImportError:
+    chess = None
+
+TABLE_NAME = re.compile(r'^(K[QRBNP]*)v(K[QRBNP]*)\.rtbw$')
+
+class TablebaseProber:
+    """
+    Perfect moves for endgames from Syzygy tablebases (.rtbw and .rtbz
+    files) in a local directory. Tables are opened and memory mapped the
+    first time they are needed, and at most max_open of them are kept
+    open: the least recently used are closed first. Answers for recently
+    probed positions are cached as well.
+    """
+
+    def __init__(self, directory, max_open=16, cache_size=1024):
+        self.directory = directory
+        self.max_open = max_open
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.tables = None      # opened on first probe
+        self.cache = OrderedDict()
+        # statistics
+        self.probes = 0
+        self.found = 0
+        self.cache_hits = 0
+        self.probe_time = 0.0
+
+        # largest number of pieces we have both wdl and dtz tables for
+        self.max_pieces = 0
+        self.count = 0
+        if os.path.isdir(directory):
+            files = set(os.listdir(directory))
+            for name in files:
+                m = TABLE_NAME.match(name)
+                if m and name[:-4] + 'rtbz' in files:
+                    self.count += 1
+                    self.max_pieces = max(self.max_pieces, len(m.group(1)) + len(m.group(2)))
+
+    def available(self):
+        return chess != None and self.max_pieces > 0
+
+    def covers(self, position):
+        """ Could the tables have this position? They don't know about castling. """
+        pieces = bin(position.occ[0] | position.occ[1]).count('1')
+        return self.available() and pieces <= self.max_pieces and position.castling == 0
+
+    def open(self):
+        if self.tables == None:
+            if hasattr(chess.syzygy, 'open_tablebase'):
+                self.tables = chess.syzygy.open_tablebase(self.directory, max_fds=self.max_open)
+            else:
+                self.tables = chess.syzygy.open_tablebases(self.directory, max_fds=self.max_open)
+        return self.tables
+
+    def bestMove(self, position):
+        """
+        The best move in a Position, as a string, or None if the tables
+        don't cover it. Wins are converted as quickly as possible, losses
+        are dragged out as long as possible.
+        """
+        if not self.covers(position):
+            return None
+        key = position.fenKey()
+        with self.lock:
+            self.probes += 1
+            if key in self.cache:
+                move = self.cache.pop(key)
+                self.cache[key] = move
+                self.cache_hits += 1
+                return move
+            start = time.time()
+            move = self.probe(position.toFen())
+            self.probe_time += time.time() - start
+            self.cache[key] = move
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            if move != None:
+                self.found += 1
+            return move
+
+    def probe(self, fen):
+        tables = self.open()
+        board = chess.Board(fen)
+        best, best_rank = None, None
+        for move in list(board.legal_moves):
+            zeroing = board.is_zeroing(move)
+            board.push(move)
+            try:
+                if board.is_checkmate():
+                    return move.uci()
+                # scores are for the opponent, who is now to move
+                wdl = -tables.probe_wdl(board)
+                dtz = abs(tables.probe_dtz(board))
+            except KeyError:
+                return None     # a table we need is missing
+            finally:
+                board.pop()
+            if wdl > 0:
+                rank = (wdl, zeroing, -dtz)         # reset the 50 move count, or get there fastest
+            elif wdl < 0:
+                rank = (wdl, not zeroing, dtz)      # take as long as we can
+            else:
+                rank = (0, 0, 0)
+            if best_rank == None or rank > best_rank:
+                best, best_rank = move.uci(), rank
+        return best
+
+    def getStats(self):
+        return { 'tables': self.count,
+                 'max_pieces': self.max_pieces,
+                 'probes': self.probes,
+                 'found': self.found,
+                 'cache_hits': self.cache_hits,
+                 'mean_probe': self.probe_time / max(self.probes - self.cache_hits, 1) }
+
+    def close(self):
+        with self.lock:
+            if self.tables != None:
+                self.tables.close()
+                self.tables = None
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+"""
+Plays a number of engine vs engine games side by side on an EnginePool
+and reports queue depth and request latency.
+
+  engine_pool_test.py [games] [plies] [engines]
+"""
+
+from __future__ import print_function
+
+import sys, time
+from threading import Thread
+from chess_player.bitboard_utilities import Position
+from chess_player.engine_utilities import EnginePool
+
+def playGame(pool, plies, results):
+    session = pool.newSession()
+    position = Position.initial()
+    for ply in range(plies):
+        move = pool.think(session, position.toFen()).result()
+        if move == None or not position.pushString(move):
+            break
+    pool.closeSession(session)
+    results.append(len(position.stack))
+
+if __name__=='__main__':
+    games = 8
+    plies = 10
+    engines = None  # one per core
+    if len(sys.argv) > 1:
+        games = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        plies = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        engines = int(sys.argv[3])
+
+    pool = EnginePool(engines)
+    results = list()
+    t = time.time()
+    threads = [Thread(target=playGame, args=(pool, plies, results)) for i in range(games)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    dt = time.time() - t
+
+    stats = pool.getStats()
+    pool.close()
+    print("%d games, %d plies played in %.1fs on %d engines" % (games, sum(results), dt, stats['processes']))
+    for key in sorted(stats.keys()):
+        print("  %-12s %s" % (key, stats[key]))
+    if sum(results) != games * plies:
+        print("some games did not finish")
+        sys.exit(1)
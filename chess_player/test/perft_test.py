@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+"""
+Perft check and benchmark of the bitboard move generator.
+
+  perft_test.py [max_depth]
+
+Positions and node counts are the standard ones from the chess
+programming wiki, they exercise castling, en passant and promotion.
+"""
+
+from __future__ import print_function
+
+import sys, time
+from chess_player.bitboard_utilities import *
+
+POSITIONS = [
+    ("start", START_FEN,
+        [20, 400, 8902, 197281, 4865609]),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+        [48, 2039, 97862, 4085603]),
+    ("position 3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+        [14, 191, 2812, 43238, 674624]),
+    ("position 4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+        [6, 264, 9467, 422333]),
+    ("position 5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+        [44, 1486, 62379, 2103487]),
+    ("position 6", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+        [46, 2079, 89890, 3894594]),
+]
+
+if __name__=='__main__':
+    max_depth = 3
+    if len(sys.argv) > 1:
+        max_depth = int(sys.argv[1])
+
+    failures = 0
+    total_nodes = 0
+    total_time = 0.0
+    for (name, fen, counts) in POSITIONS:
+        pos = Position.fromFen(fen)
+        for depth in range(1, min(max_depth, len(counts))+1):
+            t = time.time()
+            nodes = pos.perft(depth)
+            dt = time.time() - t
+            total_nodes += nodes
+            total_time += dt
+            status = "ok"
+            if nodes != counts[depth-1]:
+                status = "FAIL (expected %d)" % counts[depth-1]
+                failures += 1
+            print("%-10s depth %d: %9d nodes %8.3fs %9.0f nodes/sec %s" %
+                  (name, depth, nodes, dt, nodes/max(dt, 1e-9), status))
+        if pos.toFen() != fen:
+            print("%-10s position changed by perft: %s" % (name, pos.toFen()))
+            failures += 1
+
+    print("total: %d nodes in %.3fs, %.0f nodes/sec" % (total_nodes, total_time, total_nodes/max(total_time, 1e-9)))
+    if failures:
+        print("%d failures" % failures)
+        sys.exit(1)
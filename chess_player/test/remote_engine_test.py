@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""
+Starts an EngineServer on localhost and plays a number of games side by
+side through a RemoteEnginePool, with every game's requests pipelined on
+one connection. Then stops the server mid game and checks a
+GnuChessEngine in client mode carries on locally.
+
+  remote_engine_test.py [games] [plies] [engines]
+"""
+
+from __future__ import print_function
+
+import sys, time
+from threading import Thread
+from chess_player.engine_utilities import EnginePool
+from chess_player.remote_utilities import EngineServer, RemoteEnginePool
+from chess_player.chess_utilities import BoardState, GnuChessEngine
+from engine_pool_test import playGame
+
+if __name__=='__main__':
+    games = 4
+    plies = 10
+    engines = 2
+    if len(sys.argv) > 1:
+        games = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        plies = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        engines = int(sys.argv[3])
+
+    pool = EnginePool(engines)
+    server = EngineServer(pool, 'localhost', 0).start()
+    remote = RemoteEnginePool('localhost', server.port)
+    results = list()
+    t = time.time()
+    threads = [Thread(target=playGame, args=(remote, plies, results)) for i in range(games)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    dt = time.time() - t
+
+    stats = remote.getStats()
+    print("%d games, %d plies played in %.1fs on %d remote engines" % (games, sum(results), dt, engines))
+    for key in sorted(stats.keys()):
+        print("  %-12s %s" % (key, stats[key]))
+    ok = sum(results) == games * plies
+    if not ok:
+        print("some games did not finish")
+
+    # server goes away, client should go local
+    board = BoardState()
+    board.newGame()
+    engine = GnuChessEngine(pool = remote, timeout = 10.0)
+    first = engine.nextMove("e2e4", board)
+    server.close()
+    pool.close()
+    second = engine.nextMove("d2d4", board)
+    print("remote answered %s, local answered %s, playing locally: %s" % (first, second, engine.pool == None))
+    ok = ok and first != None and second != None and engine.pool == None
+    engine.exit()
+    remote.close()
+    if not ok:
+        sys.exit(1)